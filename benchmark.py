@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""Time the hot paths against synthetic SRTM tiles, without any network.
+
+Tiles with known void patterns are generated into a temporary cache dir
+together with a catalog listing them, so SRTMManager never contacts the
+server. Results are printed as JSON.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+
+from catalog import TileCatalog
+from srtm import SRTMManager, SRTMTile, SRTM_VOID
+from region import Region
+from gpx_manager import GPXManager
+
+
+# crosses both a latitude and a longitude tile boundary
+BENCH_BOUNDS = {"north_lat": 38.1, "east_lng": -121.85,
+                "south_lat": 37.85, "west_lng": -122.15}
+
+# SRTM1 tiles are 3601x3601 pixels, SRTM3 tiles 1201x1201
+TILE_SIZES = {1: 3601, 3: 1201}
+
+
+def synthetic_grid(lat, lon, size, void_fraction=0.002, void_blocks=4):
+    """Return a tile of smooth hills plus noise, with void_fraction of the
+    pixels voided at random and void_blocks square holes of up to 60 pixels
+    across. The pattern only depends on lat, lon and size."""
+    rng = np.random.RandomState((lat * 1000 + lon) % (2 ** 32))
+    yy, xx = np.mgrid[0:size, 0:size] / float(size - 1)
+    grid = 800 * np.sin(3 * (xx + lon)) * np.cos(2 * (yy + lat)) + 600 + \
+        rng.normal(0, 5, (size, size))
+    grid = grid.astype(np.int16)
+    grid[rng.rand(size, size) < void_fraction] = SRTM_VOID
+    for i in range(void_blocks):
+        height, width = rng.randint(2, 60, 2)
+        top, left = rng.randint(0, size - 60, 2)
+        grid[top:top + height, left:left + width] = SRTM_VOID
+    return grid
+
+
+def tile_name(lat, lon):
+    return '%s%02d%s%03d' % ('N' if lat >= 0 else 'S', abs(lat),
+                             'E' if lon >= 0 else 'W', abs(lon))
+
+
+def make_tiles(cachedir, srtm_format, keys):
+    """Write synthetic .hgt.zip tiles for keys and a catalog that lists
+    them into cachedir."""
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    size = TILE_SIZES[srtm_format]
+    files = []
+    for lat, lon in keys:
+        filename = tile_name(lat, lon) + '.hgt.zip'
+        grid = synthetic_grid(lat, lon, size)
+        zipf = zipfile.ZipFile(os.path.join(cachedir, filename), 'w',
+                               zipfile.ZIP_DEFLATED)
+        zipf.writestr(tile_name(lat, lon) + '.hgt',
+                      grid.astype('>i2').tostring())
+        zipf.close()
+        files.append((lat, lon, 'Synthetic/', filename))
+    tile_catalog = TileCatalog(os.path.join(cachedir, "catalog.sqlite"))
+    tile_catalog.set_remote(files, "localhost",
+                            "/srtm/version2_1/SRTM%s/" % srtm_format)
+    tile_catalog.close()
+    return files
+
+
+class Benchmark:
+    """Runs timed steps and collects their results."""
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def time(self, name, func, setup=None, repeat=None, **params):
+        """Time func repeat times, calling setup before each run without
+        timing it. An exception is recorded and ends that step."""
+        seconds = []
+        error = None
+        for i in range(repeat or self.repeat):
+            try:
+                if setup is not None:
+                    setup()
+                start = time.time()
+                func()
+                seconds.append(time.time() - start)
+            except Exception as e:
+                error = "%s: %s" % (type(e).__name__, e)
+                break
+        result = {"name": name, "params": params, "seconds": seconds}
+        if seconds:
+            result["min"] = min(seconds)
+            result["mean"] = sum(seconds) / len(seconds)
+        if error:
+            result["error"] = error
+        self.results.append(result)
+        sys.stderr.write("%-14s %-40s %s\n" % (
+            name, json.dumps(params, sort_keys=True),
+            error or "%.4fs" % result["min"]))
+        return result
+
+
+def bench_tiles(bench, srtm_format, cachedir, key):
+    zip_filepath = os.path.join(cachedir, tile_name(*key) + '.hgt.zip')
+    grid_filepath = SRTMTile.grid_filename(zip_filepath)
+
+    def remove_grid():
+        if os.path.exists(grid_filepath):
+            os.remove(grid_filepath)
+
+    bench.time("tile_convert", lambda: SRTMTile(zip_filepath, *key),
+               setup=remove_grid, srtm_format=srtm_format)
+    bench.time("tile_load", lambda: SRTMTile(zip_filepath, *key),
+               srtm_format=srtm_format)
+
+    # fill_nulls patches the tile it is called on, so start from a fresh one
+    tiles = []
+
+    def load():
+        tiles[:] = [SRTMTile(zip_filepath, *key)]
+
+    load()
+    bench.time("fill_nulls", lambda: tiles[0].fill_nulls(), setup=load,
+               srtm_format=srtm_format,
+               voids=int((tiles[0].grid == SRTM_VOID).sum()))
+
+
+def bench_patch(bench, srtm_format, workdir, keys):
+    """Time fetching every tile through the manager, which fills and saves
+    the patched tiles the first time."""
+    def remove_patched():
+        cachedir = os.path.join(workdir, 'srtm%d' % srtm_format)
+        for filepath in glob.glob(os.path.join(cachedir, '*.patched.*')):
+            os.remove(filepath)
+        tile_catalog = TileCatalog(os.path.join(cachedir, "catalog.sqlite"))
+        tile_catalog.scan(cachedir)
+        tile_catalog.close()
+
+    def fetch():
+        srtm_manager = SRTMManager(cachedir=os.path.join(workdir, 'srtm'),
+                                   srtm_format=srtm_format, offline=True)
+        for key in keys:
+            srtm_manager.fetchTile(*key)
+
+    bench.time("fetch_patch", fetch, setup=remove_patched, repeat=1,
+               srtm_format=srtm_format, tiles=len(keys))
+
+
+def bench_region(bench, srtm_manager, resolutions, parsed_data_dir,
+                 image_dir):
+    srtm_format = srtm_manager.srtm_format
+    regions = {}
+    for resolution in resolutions:
+        def overlay():
+            region = Region(resolution=resolution,
+                            base_cache_dir=parsed_data_dir, no_cache=True,
+                            srtm_format=srtm_format, auto_parse=False,
+                            srtm_manager=srtm_manager, **BENCH_BOUNDS)
+            region._overlay_map()
+            regions[resolution] = region
+        bench.time("overlay_map", overlay, srtm_format=srtm_format,
+                   resolution=resolution)
+
+    # the remaining steps work on the map at the middle resolution
+    resolution = sorted(regions)[len(regions) // 2]
+    region = regions[resolution]
+    original = np.array(region.outfile)
+
+    def reset():
+        region.outfile = np.array(original)
+
+    bench.time("contour", lambda: region.contour(100), setup=reset,
+               srtm_format=srtm_format, resolution=resolution, delta=100)
+    bench.time("median_filter", lambda: region.median_filter(5),
+               setup=reset, srtm_format=srtm_format, resolution=resolution,
+               kernel_size=5)
+
+    from elevation import save_figure
+    reset()
+    bench.time("png_save", lambda: save_figure(
+        region, os.path.join(image_dir, 'bench.png')),
+        srtm_format=srtm_format, resolution=resolution)
+
+
+def bench_gpx(bench, srtm_manager, resolution, parsed_data_dir, gpx_files):
+    srtm_format = srtm_manager.srtm_format
+    for gpx_filepath in gpx_files:
+        name = os.path.basename(gpx_filepath)
+        bench.time("gpx_parse", lambda: GPXManager(gpx_filepath), gpx=name)
+        gpx_manager = GPXManager(gpx_filepath)
+        bounds = gpx_manager.get_boundaries()
+        region = Region(bounds['ne']['lat'], bounds['ne']['lng'],
+                        bounds['sw']['lat'], bounds['sw']['lng'],
+                        resolution=resolution, base_cache_dir=parsed_data_dir,
+                        no_cache=True, srtm_format=srtm_format,
+                        auto_parse=False, srtm_manager=srtm_manager)
+        region._overlay_map()
+        original = np.array(region.outfile)
+
+        def reset():
+            region.outfile = np.array(original)
+
+        bench.time("overlay_gps", lambda: region.overlay_gps(
+            gpx_manager.segments), setup=reset, srtm_format=srtm_format,
+            resolution=resolution, gpx=name, points=gpx_manager.distance.size)
+
+
+def tile_keys(gpx_files, parsed_data_dir):
+    """The tiles under BENCH_BOUNDS and every padded gpx track."""
+    bounds = [BENCH_BOUNDS]
+    for gpx_filepath in gpx_files:
+        gpx_bounds = GPXManager(gpx_filepath).get_boundaries()
+        bounds.append({"north_lat": gpx_bounds['ne']['lat'],
+                       "east_lng": gpx_bounds['ne']['lng'],
+                       "south_lat": gpx_bounds['sw']['lat'],
+                       "west_lng": gpx_bounds['sw']['lng']})
+    keys = set()
+    for b in bounds:
+        region = Region(base_cache_dir=parsed_data_dir, auto_parse=False,
+                        **b)
+        keys.update(region.footprint_tiles())
+    return sorted(keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark against synthetic SRTM tiles.')
+    parser.add_argument('--srtm_formats', default="1,3",
+                        help='Comma separated SRTM formats. Default = 1,3')
+    parser.add_argument('--resolutions', default="250,500,1000",
+                        help='Comma separated map resolutions. '
+                        'Default = 250,500,1000')
+    parser.add_argument('--repeat', default=3,
+                        help='Runs of each step, the fastest counts. '
+                        'Default = 3')
+    parser.add_argument('--gpx', default="gpx/*.gpx",
+                        help='GPX files to overlay. Default = gpx/*.gpx')
+    parser.add_argument('--output', '-o',
+                        help='File to write the JSON results to instead of '
+                        'stdout')
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help="Keep the temporary dir with the tiles")
+    args = parser.parse_args()
+
+    srtm_formats = [int(f) for f in args.srtm_formats.split(',')]
+    resolutions = [int(r) for r in args.resolutions.split(',')]
+    gpx_files = sorted(glob.glob(args.gpx))
+    bench = Benchmark(int(args.repeat))
+
+    # the code under test prints progress, keep stdout for the results
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+
+    workdir = tempfile.mkdtemp(prefix='srtm-bench-')
+    try:
+        parsed_data_dir = os.path.join(workdir, 'parsed_data')
+        keys = tile_keys(gpx_files, parsed_data_dir)
+        for srtm_format in srtm_formats:
+            cachedir = os.path.join(workdir, 'srtm%d' % srtm_format)
+            start = time.time()
+            make_tiles(cachedir, srtm_format, keys)
+            sys.stderr.write("generated %d SRTM%d tiles in %.1fs\n" % (
+                len(keys), srtm_format, time.time() - start))
+
+            bench_tiles(bench, srtm_format, cachedir, keys[0])
+            bench_patch(bench, srtm_format, workdir, keys)
+
+            srtm_manager = SRTMManager(
+                cachedir=os.path.join(workdir, 'srtm'),
+                srtm_format=srtm_format, offline=True)
+            bench_region(bench, srtm_manager, resolutions, parsed_data_dir,
+                         workdir)
+            bench_gpx(bench, srtm_manager, resolutions[len(resolutions) // 2],
+                      parsed_data_dir, gpx_files)
+    finally:
+        sys.stdout = stdout
+        if args.keep:
+            sys.stderr.write("kept %s\n" % workdir)
+        else:
+            shutil.rmtree(workdir)
+
+    report = {"python": platform.python_version(),
+              "numpy": np.__version__,
+              "platform": platform.platform(),
+              "repeat": bench.repeat,
+              "tiles": keys,
+              "results": bench.results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(output + "\n")
+        f.close()
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+"""Keep cache/srtm<N> and cache/parsed_data within disk budgets.
+
+The caches hold three classes of entries:
+raw      a downloaded tile, its unzipped grid and overviews
+patched  a tile with its voids filled, by us or by SRTMFill, and its grid
+         and overviews. These take minutes to recompute, so they are
+         evicted later than raw tiles of the same age
+regions  a region dir in cache/parsed_data
+
+Each cache dir has an access log with the hits and last access of its
+entries. Pruning evicts the least recently used entries of a class until
+it fits its limit, and then the entries with the largest age / weight
+until everything fits the total limit. Entries held by a running render
+are never evicted: renders hold them with hold() and release(), which
+leave a <name>.<pid> file in the .in_use dir of the cache while held.
+
+Sample calls:
+python cache_manager.py report
+
+python cache_manager.py prune --max_raw 20G --max_regions 5G --max_total 50G
+
+"""
+import os
+import json
+import time
+import errno
+import shutil
+import sqlite3
+import argparse
+import threading
+
+import catalog
+from region_index import RegionCacheIndex
+
+
+ACCESS_FILENAME = "access.sqlite"
+IN_USE_DIRNAME = ".in_use"
+
+# how much longer than a raw tile an entry may go unused before eviction
+DEFAULT_WEIGHTS = {"raw": 1.0, "patched": 8.0, "regions": 2.0}
+
+CLASSES = ["raw", "patched", "regions"]
+
+# the class of a tile file, from the flag of the file or of the file an
+# overview was built from
+TILE_CLASSES = {catalog.RAW: "raw", catalog.RAW_GRID: "raw",
+                catalog.PATCHED: "patched", catalog.PATCHED_GRID: "patched",
+                catalog.FILLED: "patched", catalog.FILLED_GRID: "patched"}
+
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+class AccessLog:
+    """Hits and last access time of the entries of a cache dir, in a
+    sqlite file shared by every process using the cache."""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filepath, timeout=60,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS access ("
+                             "name TEXT PRIMARY KEY, "
+                             "hits INTEGER NOT NULL DEFAULT 0, "
+                             "last_access REAL)")
+            self._db.commit()
+
+    def touch(self, name):
+        """Record an access of the entry name."""
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR IGNORE INTO access (name) VALUES (?)", (name,))
+                self._db.execute(
+                    "UPDATE access SET hits = hits + 1, last_access = ? "
+                    "WHERE name = ?", (time.time(), name))
+
+    def stats(self):
+        """Return a dict of entry name to (hits, last access time)."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT name, hits, last_access FROM access").fetchall()
+        return dict((name, (hits, last_access))
+                    for name, hits, last_access in rows)
+
+    def forget(self, name):
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM access WHERE name = ?", (name,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def tile_entry_name(lat, lon, cls):
+    return "%d,%d,%s" % (lat, lon, cls)
+
+
+def tile_hold_name(lat, lon):
+    """Tiles are held as a whole, every class of their files."""
+    return "%d,%d" % (lat, lon)
+
+
+def parse_tile_entry_file(filename):
+    """Return (lat, lon, class) of a file in a tile cache dir, or None for
+    files that do not belong to a tile."""
+    parsed = catalog.parse_tile_file(filename)
+    if parsed is None:
+        return None
+    lat, lon, flag, factor = parsed
+    if factor is not None:
+        # classify an overview by the file it was built from
+        base = filename[:filename.rindex('.ov')]
+        parsed = catalog.parse_tile_file(base + '.npy')
+        if parsed is None:
+            return None
+        flag = parsed[2]
+    return lat, lon, TILE_CLASSES[flag]
+
+
+# per process count of the holds of each hold file, so threads of one
+# process can hold the same entry
+_holds = {}
+_holds_lock = threading.Lock()
+
+
+def _hold_filepath(cachedir, name):
+    return os.path.join(cachedir, IN_USE_DIRNAME,
+                        "%s.%d" % (name, os.getpid()))
+
+
+def hold(cachedir, names):
+    """Mark the entries names of cachedir as in use by this process."""
+    in_use_dir = os.path.join(cachedir, IN_USE_DIRNAME)
+    with _holds_lock:
+        for name in names:
+            filepath = _hold_filepath(cachedir, name)
+            if _holds.get(filepath, 0) == 0:
+                if not os.path.isdir(in_use_dir):
+                    try:
+                        os.makedirs(in_use_dir)
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                open(filepath, 'w').close()
+            _holds[filepath] = _holds.get(filepath, 0) + 1
+
+
+def release(cachedir, names):
+    """Undo hold."""
+    with _holds_lock:
+        for name in names:
+            filepath = _hold_filepath(cachedir, name)
+            count = _holds.get(filepath, 0) - 1
+            if count > 0:
+                _holds[filepath] = count
+                continue
+            _holds.pop(filepath, None)
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def held_names(cachedir):
+    """Return the names held by running processes in cachedir, removing
+    the hold files of processes that died without releasing them."""
+    in_use_dir = os.path.join(cachedir, IN_USE_DIRNAME)
+    names = set()
+    if not os.path.isdir(in_use_dir):
+        return names
+    for filename in os.listdir(in_use_dir):
+        name, _, pid = filename.rpartition('.')
+        if not pid.isdigit():
+            continue
+        if _pid_alive(int(pid)):
+            names.add(name)
+        else:
+            try:
+                os.remove(os.path.join(in_use_dir, filename))
+            except OSError:
+                pass
+    return names
+
+
+def parse_size(size):
+    """Parse a size like 500M or 20G into bytes."""
+    size = str(size).strip().upper()
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def format_size(nbytes):
+    for unit in ["T", "G", "M", "K"]:
+        if nbytes >= SIZE_UNITS[unit]:
+            return "%.1f%s" % (float(nbytes) / SIZE_UNITS[unit], unit)
+    return "%d" % nbytes
+
+
+def _dir_size(dirpath):
+    size = 0
+    latest = 0
+    for root, dirs, files in os.walk(dirpath):
+        for filename in files:
+            try:
+                stat = os.stat(os.path.join(root, filename))
+            except OSError:
+                continue  # removed while we looked
+            size += stat.st_size
+            latest = max(latest, stat.st_mtime)
+    return size, latest
+
+
+class CacheEntry:
+    """A unit of eviction: the files of one class of a tile, or a region
+    dir."""
+    def __init__(self, cls, cachedir, name, hold_name):
+        self.cls = cls
+        self.cachedir = cachedir
+        self.name = name
+        self.hold_name = hold_name
+        self.paths = []
+        self.size = 0
+        self.modified = 0
+        self.hits = 0
+        self.last_access = None
+        self.held = False
+
+    @property
+    def last_used(self):
+        """Last access, or the last change for entries never accessed since
+        the access log was started."""
+        if self.last_access is None:
+            return self.modified
+        return self.last_access
+
+    def add_file(self, filepath):
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return
+        self.paths.append(filepath)
+        self.size += stat.st_size
+        self.modified = max(self.modified, stat.st_mtime)
+
+
+class CacheManager:
+    """Reports on and prunes the tile caches <cache_root>/srtm<N> and the
+    region cache <cache_root>/parsed_data.
+
+    limits maps a class to its size limit in bytes, max_total limits all
+    classes together and weights scales the age of each class when
+    entries of different classes compete for the total limit.
+    """
+    def __init__(self, cache_root="cache", limits=None, max_total=None,
+                 weights=None):
+        self.cache_root = cache_root
+        self.limits = limits or {}
+        self.max_total = max_total
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.weights.update(weights or {})
+
+    def tile_dirs(self):
+        if not os.path.isdir(self.cache_root):
+            return []
+        return sorted(os.path.join(self.cache_root, name)
+                      for name in os.listdir(self.cache_root)
+                      if name.startswith("srtm") and
+                      os.path.isdir(os.path.join(self.cache_root, name)))
+
+    @property
+    def region_dir(self):
+        return os.path.join(self.cache_root, "parsed_data")
+
+    def entries(self):
+        """Return the CacheEntries of every cache dir, with their access
+        stats and whether they are held."""
+        entries = []
+        for cachedir in self.tile_dirs():
+            entries.extend(self._tile_entries(cachedir))
+        if os.path.isdir(self.region_dir):
+            entries.extend(self._region_entries(self.region_dir))
+
+        for cachedir in set(entry.cachedir for entry in entries):
+            stats = self._access_log(cachedir).stats()
+            held = held_names(cachedir)
+            for entry in entries:
+                if entry.cachedir != cachedir:
+                    continue
+                entry.hits, entry.last_access = stats.get(entry.name,
+                                                          (0, None))
+                entry.held = entry.hold_name in held
+        return entries
+
+    def _tile_entries(self, cachedir):
+        entries = {}
+        for filename in os.listdir(cachedir):
+            parsed = parse_tile_entry_file(filename)
+            if parsed is None:
+                continue
+            lat, lon, cls = parsed
+            name = tile_entry_name(lat, lon, cls)
+            if name not in entries:
+                entries[name] = CacheEntry(cls, cachedir, name,
+                                           tile_hold_name(lat, lon))
+            entries[name].add_file(os.path.join(cachedir, filename))
+        return entries.values()
+
+    def _region_entries(self, cachedir):
+        entries = []
+        for name in os.listdir(cachedir):
+            dirpath = os.path.join(cachedir, name)
+            if name == IN_USE_DIRNAME or not os.path.isdir(dirpath):
+                continue
+            entry = CacheEntry("regions", cachedir, name, name)
+            entry.paths = [dirpath]
+            entry.size, entry.modified = _dir_size(dirpath)
+            entries.append(entry)
+        return entries
+
+    @staticmethod
+    def _access_log(cachedir):
+        return AccessLog(os.path.join(cachedir, ACCESS_FILENAME))
+
+    def report(self, entries=None):
+        """Return per class totals: entries, bytes, hits, entries held and
+        the oldest last use."""
+        if entries is None:
+            entries = self.entries()
+        report = {}
+        for cls in CLASSES:
+            of_class = [entry for entry in entries if entry.cls == cls]
+            report[cls] = {
+                "entries": len(of_class),
+                "bytes": sum(entry.size for entry in of_class),
+                "hits": sum(entry.hits for entry in of_class),
+                "held": sum(1 for entry in of_class if entry.held),
+                "oldest_use": min([entry.last_used for entry in of_class] or
+                                  [None]),
+                "limit": self.limits.get(cls)}
+        return report
+
+    def _score(self, entry, now):
+        # larger means evict sooner
+        return (now - entry.last_used) / self.weights.get(entry.cls, 1.0)
+
+    def plan(self, entries=None):
+        """Return the entries prune would evict, in order."""
+        if entries is None:
+            entries = self.entries()
+        now = time.time()
+        candidates = [entry for entry in entries if not entry.held]
+        evict = []
+
+        for cls, limit in self.limits.items():
+            if limit is None:
+                continue
+            total = sum(entry.size for entry in entries if entry.cls == cls)
+            for entry in sorted([e for e in candidates if e.cls == cls],
+                                key=lambda e: e.last_used):
+                if total <= limit:
+                    break
+                evict.append(entry)
+                total -= entry.size
+
+        if self.max_total is not None:
+            total = sum(entry.size for entry in entries) - \
+                sum(entry.size for entry in evict)
+            remaining = [entry for entry in candidates if entry not in evict]
+            remaining.sort(key=lambda e: self._score(e, now), reverse=True)
+            for entry in remaining:
+                if total <= self.max_total:
+                    break
+                evict.append(entry)
+                total -= entry.size
+        return evict
+
+    def prune(self, dry_run=False):
+        """Evict entries until the caches fit their limits. Returns the
+        evicted entries."""
+        evicted = []
+        for entry in self.plan():
+            # a render may have started using it since we looked
+            if entry.hold_name in held_names(entry.cachedir):
+                continue
+            if not dry_run:
+                self.evict(entry)
+            evicted.append(entry)
+        return evicted
+
+    def evict(self, entry):
+        print "evicting %s %s in %s (%s)" % (
+            entry.cls, entry.name, entry.cachedir, format_size(entry.size))
+        if entry.cls == "regions":
+            shutil.rmtree(entry.paths[0], ignore_errors=True)
+            index = RegionCacheIndex(entry.cachedir)
+            index.remove(entry.name)
+        else:
+            for filepath in entry.paths:
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+            lat, lon = [int(v) for v in entry.hold_name.split(',')]
+            tile_catalog = catalog.open_catalog(
+                os.path.join(entry.cachedir, "catalog.sqlite"))
+            tile_catalog.scan(entry.cachedir, (lat, lon))
+            tile_catalog.close()
+        self._access_log(entry.cachedir).forget(entry.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report on and prune the SRTM and region caches.')
+    parser.add_argument('command', choices=["report", "prune"])
+    parser.add_argument('--cache_root', default="cache",
+                        help='Dir holding srtm<N> and parsed_data. '
+                        'Default = cache')
+    for cls in CLASSES:
+        parser.add_argument('--max_%s' % cls,
+                            help='Size limit of the %s entries, eg. 500M '
+                            'or 20G' % cls)
+    parser.add_argument('--max_total',
+                        help='Size limit of all entries together')
+    for cls in CLASSES:
+        parser.add_argument('--weight_%s' % cls, type=float,
+                            help='How many times longer than a raw tile a '
+                            '%s entry may go unused before it is evicted '
+                            'for the total limit. Default = %s' % (
+                                cls, DEFAULT_WEIGHTS[cls]))
+    parser.add_argument('--dry_run', action='store_true', default=False,
+                        help="Only list what prune would evict")
+    parser.add_argument('--json', action='store_true', default=False,
+                        help="Print the report as JSON")
+    args = parser.parse_args()
+
+    limits = {}
+    weights = {}
+    for cls in CLASSES:
+        if getattr(args, 'max_%s' % cls):
+            limits[cls] = parse_size(getattr(args, 'max_%s' % cls))
+        if getattr(args, 'weight_%s' % cls) is not None:
+            weights[cls] = getattr(args, 'weight_%s' % cls)
+    max_total = parse_size(args.max_total) if args.max_total else None
+    manager = CacheManager(args.cache_root, limits, max_total, weights)
+
+    if args.command == "prune":
+        evicted = manager.prune(dry_run=args.dry_run)
+        print "%s %d entries, %s" % (
+            "would evict" if args.dry_run else "evicted", len(evicted),
+            format_size(sum(entry.size for entry in evicted)))
+
+    report = manager.report()
+    if args.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+        return
+    now = time.time()
+    print "%-8s %8s %10s %8s %6s %12s %10s" % (
+        "class", "entries", "size", "hits", "held", "oldest use", "limit")
+    for cls in CLASSES:
+        stats = report[cls]
+        oldest = "-"
+        if stats["oldest_use"] is not None:
+            oldest = "%.1f days" % ((now - stats["oldest_use"]) / 86400)
+        limit = "-"
+        if stats["limit"] is not None:
+            limit = format_size(stats["limit"])
+        print "%-8s %8d %10s %8d %6d %12s %10s" % (
+            cls, stats["entries"], format_size(stats["bytes"]),
+            stats["hits"], stats["held"], oldest, limit)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""SQLite catalog of the SRTM tiles a server offers and of the files each
+tile has in the local cache.
+
+One row per tile holds where to download it from and bit flags for the
+cached files, so looking up a tile is a primary key query instead of
+unpickling the whole file list and probing the cache dir for every kind of
+file. The manager updates the flags as it downloads, patches and converts
+tiles.
+
+Sample calls:
+catalog = TileCatalog("cache/srtm1/catalog.sqlite")
+
+catalog.lookup(37, -123)
+
+catalog.mark(37, -123, PATCHED | PATCHED_GRID)
+
+"""
+import os
+import re
+import pickle
+import sqlite3
+import threading
+from collections import namedtuple
+
+
+# local files of a tile, as bit flags
+RAW = 1  # <name>.hgt.zip as downloaded
+RAW_GRID = 2  # its unzipped <name>.hgt.npy
+PATCHED = 4  # <name>.patched.hgt.zip with voids filled here
+PATCHED_GRID = 8
+FILLED = 16  # <name>_fill.zip from SRTMFill
+FILLED_GRID = 32
+
+# the unzipped grid of each kind of zip
+GRID_FLAGS = {RAW: RAW_GRID, PATCHED: PATCHED_GRID, FILLED: FILLED_GRID}
+
+FILE_SUFFIXES = [('.hgt.zip', RAW), ('.hgt.npy', RAW_GRID),
+                 ('.patched.hgt.zip', PATCHED),
+                 ('.patched.hgt.npy', PATCHED_GRID),
+                 ('_fill.zip', FILLED), ('_fill.npy', FILLED_GRID)]
+
+TILE_FILE_REGEX = re.compile(r"([NS])(\d+)([EW])(\d+)(\..*|_fill\..*)$")
+OVERVIEW_REGEX = re.compile(r"\.ov(\d+)\.npy$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS tiles (
+    lat INTEGER NOT NULL,
+    lon INTEGER NOT NULL,
+    region TEXT,
+    filename TEXT,
+    state INTEGER NOT NULL DEFAULT 0,
+    overviews INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (lat, lon)
+);
+"""
+
+# region is None for tiles the server does not list, filename is None for
+# tiles without a raw file. overviews is the sum of the factors of the
+# overviews built, which are powers of two.
+CatalogTile = namedtuple('CatalogTile',
+                         'lat lon region filename state overviews')
+
+
+def parse_tile_file(filename):
+    """Return (lat, lon, flag, overview factor) of a file in a tile cache
+    dir, with flag 0 for overviews, or None for other files."""
+    match = TILE_FILE_REGEX.match(filename)
+    if match is None:
+        return None
+    lat = int(match.group(2))
+    lon = int(match.group(4))
+    if match.group(1) == "S":
+        lat = -lat
+    if match.group(3) == "W":
+        lon = -lon
+    suffix = match.group(5)
+    overview = OVERVIEW_REGEX.search(suffix)
+    if overview is not None:
+        return lat, lon, 0, int(overview.group(1))
+    for file_suffix, flag in FILE_SUFFIXES:
+        if suffix == file_suffix:
+            return lat, lon, flag, None
+    return None
+
+
+def overview_bits(factor):
+    """The overviews mask of a tile with all levels up to factor."""
+    bits = 0
+    level = 2
+    while level <= factor:
+        bits |= level
+        level *= 2
+    return bits
+
+
+class TileCatalog:
+    """The catalog in a sqlite file, shared by the threads of a process and
+    by processes using the same cache dir."""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filepath, timeout=60,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        with self._lock:
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM tiles")[0][0]
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def get_meta(self, key):
+        rows = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        if rows:
+            return rows[0][0]
+        return None
+
+    def lookup(self, lat, lon):
+        """Return the CatalogTile of (lat, lon), or None."""
+        rows = self._query("SELECT lat, lon, region, filename, state, "
+                           "overviews FROM tiles WHERE lat = ? AND lon = ?",
+                           (lat, lon))
+        if rows:
+            return CatalogTile(*rows[0])
+        return None
+
+    def tiles(self):
+        """All CatalogTiles."""
+        return [CatalogTile(*row) for row in self._query(
+            "SELECT lat, lon, region, filename, state, overviews FROM tiles "
+            "ORDER BY lat, lon")]
+
+    def is_listed(self):
+        """Whether the server's file list was stored."""
+        return self.get_meta("server") is not None
+
+    def set_remote(self, files, server, directory):
+        """Store the server's file list, (lat, lon, region, filename) for
+        every tile, keeping the local state of the tiles."""
+        with self._lock:
+            with self._db:
+                for lat, lon, region, filename in files:
+                    self._db.execute(
+                        "INSERT OR IGNORE INTO tiles (lat, lon) VALUES (?, ?)",
+                        (lat, lon))
+                    self._db.execute(
+                        "UPDATE tiles SET region = ?, filename = ? "
+                        "WHERE lat = ? AND lon = ?",
+                        (region, filename, lat, lon))
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [("server", server), ("directory", directory)])
+
+    def migrate_filelist(self, filelist_filepath):
+        """Store a file list pickled by older versions of SRTMManager."""
+        with open(filelist_filepath, 'rb') as f:
+            filelist = pickle.load(f)
+        files = [key + value for key, value in filelist.items()
+                 if isinstance(key, tuple)]
+        self.set_remote(files, filelist.get("server", ""),
+                        filelist.get("directory", ""))
+
+    def mark(self, lat, lon, flags=0, overviews=0):
+        """Record new local files of a tile."""
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR IGNORE INTO tiles (lat, lon) VALUES (?, ?)",
+                    (lat, lon))
+                self._db.execute(
+                    "UPDATE tiles SET state = state | ?, "
+                    "overviews = overviews | ? WHERE lat = ? AND lon = ?",
+                    (flags, overviews, lat, lon))
+
+    def unmark(self, lat, lon, flags=0, overviews=0):
+        """Record that local files of a tile were removed."""
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "UPDATE tiles SET state = state & ~?, "
+                    "overviews = overviews & ~? WHERE lat = ? AND lon = ?",
+                    (flags, overviews, lat, lon))
+
+    def scan(self, cachedir, key=None):
+        """Set the local state of every tile, or only of the tile key, from
+        the files in cachedir. Returns whether anything changed."""
+        found = {}
+        for filename in os.listdir(cachedir):
+            parsed = parse_tile_file(filename)
+            if parsed is None:
+                continue
+            lat, lon, flag, factor = parsed
+            if key is not None and (lat, lon) != tuple(key):
+                continue
+            state, overviews, raw_filename = found.get((lat, lon),
+                                                       (0, 0, None))
+            if factor is not None:
+                overviews |= factor
+            state |= flag
+            if flag == RAW:
+                raw_filename = filename
+            found[(lat, lon)] = (state, overviews, raw_filename)
+
+        if key is None:
+            tiles = self.tiles()
+        else:
+            tile = self.lookup(*key)
+            tiles = [tile] if tile is not None else []
+
+        changed = False
+        with self._lock:
+            with self._db:
+                for tile in tiles:
+                    state, overviews, raw_filename = found.pop(
+                        (tile.lat, tile.lon), (0, 0, None))
+                    if (state, overviews) != (tile.state, tile.overviews):
+                        self._db.execute(
+                            "UPDATE tiles SET state = ?, overviews = ? "
+                            "WHERE lat = ? AND lon = ?",
+                            (state, overviews, tile.lat, tile.lon))
+                        changed = True
+                    if tile.filename is None and raw_filename is not None:
+                        self._db.execute(
+                            "UPDATE tiles SET filename = ? "
+                            "WHERE lat = ? AND lon = ?",
+                            (raw_filename, tile.lat, tile.lon))
+                for (lat, lon), (state, overviews, raw_filename) in \
+                        found.items():
+                    self._db.execute(
+                        "INSERT INTO tiles (lat, lon, filename, state, "
+                        "overviews) VALUES (?, ?, ?, ?, ?)",
+                        (lat, lon, raw_filename, state, overviews))
+                    changed = True
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    ("scanned", "1"))
+        return changed
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_catalog(filepath):
+    """Open the catalog at filepath, starting a new one if the file is
+    not a usable catalog."""
+    try:
+        return TileCatalog(filepath)
+    except sqlite3.DatabaseError:
+        print "Unknown error loading the tile catalog. Recreating."
+        os.remove(filepath)
+        return TileCatalog(filepath)
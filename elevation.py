@@ -1,19 +1,28 @@
 #!/usr/bin/env python
+import sys
+import json
+import time
 import logging
 import argparse
+import multiprocessing
 
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 
 from pylab import *
 
+import instrument
+import tile_source
 from region import Region
+from render import save_png, save_png_stream, colorize
+from srtm import SRTMManager
 from gpx_manager import GPXManager
 
 
 logger = logging.getLogger(__name__)
 
-if __name__ == '__main__':
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Process a GPS file.')
     parser.add_argument('--gpx_filename', '-f',
                         help='GPX file for processing')
@@ -51,24 +60,93 @@ if __name__ == '__main__':
                         help='SRTM format. Default is 1')
     parser.add_argument('--patch_mode', '-u', default="auto",
                         help='Patch mode for using unpatched files.')
+    parser.add_argument('--srtm_source', '-v',
+                        help='Where to download missing SRTM files from: an '
+                        'http(s):// or ftp:// URL of the SRTM directory of a '
+                        'server, or a local mirror directory. Default = the '
+                        'USGS server')
+    parser.add_argument('--workers', '-j', default=4,
+                        help='Number of processes used to fetch and patch '
+                        'SRTM tiles and to sample the map. Default = 4')
+    parser.add_argument('--out_of_core', '-k', action='store_true',
+                        default=False, help='Keep the map on disk and '
+                        'process it in chunks, for maps too big for memory')
+    parser.add_argument('--incremental', '-I', action='store_true',
+                        default=False, help='Reuse the overlap with a cached '
+                        'map at the same resolution, eg. after panning, and '
+                        'only sample the newly exposed strips. The bounds '
+                        'shift by under half a sample to line up with it')
+    parser.add_argument('--prefetch_only', '-x', action='store_true',
+                        default=False, help='Only fetch and patch the SRTM '
+                        'tiles for the region to warm the cache, then exit')
+    parser.add_argument('--hillshade', '-H', default=0,
+                        help='Strength from 0 to 1 of hillshading blended '
+                        'into the map. Disabled by default')
+    parser.add_argument('--renderer', '-i', default="pillow",
+                        choices=["pillow", "stream", "matplotlib"],
+                        help='How to draw the image: pillow colours the map '
+                        'through a lookup table at width x dpi pixels, stream '
+                        'writes one pixel per sample a few rows at a time for '
+                        'huge maps, matplotlib draws a figure. Default = '
+                        'pillow')
+    parser.add_argument('--trace', '-z',
+                        help='File to write timing and memory spans of each '
+                        'stage to as JSON lines, - for stderr')
+    parser.add_argument('--batch', '-a',
+                        help='JSON manifest of maps to render in one process. '
+                        'It holds a list of jobs, each a dict of the long '
+                        'options above, for instance [{"gpx_filename": '
+                        '"gpx/sfpeaks.gpx", "resolution": 1000}]. Options a '
+                        'job leaves out are taken from the command line')
+    parser.add_argument('--batch_workers', '-q', default=1,
+                        help='Number of processes to render batch jobs in. '
+                        'Each job then samples its map in one process. '
+                        'Default = 1')
+    parser.add_argument('--batch_summary', '-y',
+                        help='File to write the per job summary of a batch to '
+                        '(JSON lines)')
+    return parser
 
-    args = parser.parse_args()
-
-    resolution = int(args.resolution)
-    width = int(args.width)  # we will calculate height after the aspect ratio
-    dpi = int(args.dpi)
-    valley = {"lat": None, "lng": None, "alt": 32767}
-    peak = {"lat": None, "lng": None, "alt": 0}
 
+def check_args(args):
+    """Validate and complete the options of one render. Raises ValueError
+    for invalid combinations."""
     if not (args.gpx_filename or args.bounds):
-        parser.error('You must specify --bounds and/or --gpx_filename.')
+        raise ValueError('You must specify --bounds and/or --gpx_filename.')
 
     if args.only_gps:
         args.overlay_gps = True
 
     if args.overlay_gps and not args.gpx_filename:
-        parser.error('You must specify --gpx_filename if you specify overlay_'
-                     'gps.')
+        raise ValueError('You must specify --gpx_filename if you specify '
+                         'overlay_gps.')
+
+
+def get_srtm_manager(args, srtm_managers):
+    """Return the SRTMManager for the format, patch mode and source of args
+    from srtm_managers, creating it on first use."""
+    key = (int(args.srtm_format), args.patch_mode,
+           getattr(args, 'srtm_source', None))
+    if key not in srtm_managers:
+        srtm_managers[key] = SRTMManager(
+            srtm_format=key[0], patch_mode=key[1],
+            source=tile_source.from_spec(key[2], key[0]))
+    return srtm_managers[key]
+
+
+def render(args, srtm_managers=None):
+    """Render the map described by args into images/. Returns the path of
+    the image, or None if only the tiles were prefetched.
+
+    Pass the same srtm_managers dict to several renders to share the SRTM
+    file list and tile cache between them.
+    """
+    if srtm_managers is None:
+        srtm_managers = {}
+
+    resolution = int(args.resolution)
+    width = int(args.width)  # we will calculate height after the aspect ratio
+    dpi = int(args.dpi)
 
     if args.gpx_filename:
         gpx_manager = GPXManager(args.gpx_filename)
@@ -91,35 +169,96 @@ if __name__ == '__main__':
             east_lng = float(east_lng)
 
     region = Region(north_lat, east_lng, south_lat, west_lng,
-                    resolution=int(args.resolution), no_cache=args.no_cache,
+                    resolution=resolution, no_cache=args.no_cache,
                     padding_pct=float(args.padding_pct),
                     srtm_format=int(args.srtm_format),
-                    patch_mode=args.patch_mode, auto_parse=False)
+                    patch_mode=args.patch_mode, auto_parse=False,
+                    srtm_manager=get_srtm_manager(args, srtm_managers),
+                    workers=int(args.workers), out_of_core=args.out_of_core,
+                    incremental=args.incremental)
+
+    # hold the region's cache until the image is written, so the cache
+    # manager does not prune it in the meantime
+    try:
+        if args.prefetch_only:
+            region.prefetch_tiles()
+            return None
+
+        shade = None
+        shade_strength = float(args.hillshade)
+        if not args.only_gps:
+            region.overlay_map()
+            if shade_strength > 0:
+                # shade the terrain before contours flatten it into steps
+                shade = region.hillshade()
+
+        contour_filename_suffix = ""
+        if int(args.contour) > 0:
+            region.contour(int(args.contour))
+            contour_filename_suffix = "-contour-%s" % args.contour
 
-    if not args.only_gps:
-        region.overlay_map()
+        if args.overlay_gps:
+            region.overlay_gps(gpx_manager.segments,
+                               thickness=int(args.thickness),
+                               elevation_delta=args.overlay_delta)
 
-    contour_filename_suffix = ""
-    if int(args.contour) > 0:
-        region.contour(int(args.contour))
-        contour_filename_suffix = "-contour-%s" % args.contour
+        medfilt_filename_suffix = ""
+        if str(args.median_filter) != '-1':
+            print "median filtering"
+            region.median_filter(kernel_size=int(args.median_filter))
+            medfilt_filename_suffix = "-medfilt_%s" % args.median_filter
 
-    if args.overlay_gps:
-        region.overlay_gps(gpx_manager.gpx, thickness=int(args.thickness),
-                           elevation_delta=args.overlay_delta)
+        colormap = cm.get_cmap(args.color_map)
 
+        # append to filename either the source gpx or the bounds
+        name_source = ""
+        if args.gpx_filename:
+            name_source = args.gpx_filename.split('/')[-1]
+        else:
+            name_source = "%s,%sx%s,%s" % (
+                str(south_lat)[0:7], str(west_lng)[0:7],
+                str(north_lat)[0:7], str(east_lng)[0:7])
+
+        filename = "%s-%s-%s-%s%s%s_srtm%s.png" % (
+            datetime.datetime.strftime(datetime.datetime.now(),
+                                       "%y%m%d%H%M%S"),
+            resolution, colormap.name, name_source,
+            contour_filename_suffix, medfilt_filename_suffix,
+            str(args.srtm_format))
+        filepath = "images/%s" % filename
+        if args.renderer == "matplotlib":
+            save_figure(region, filepath, width, dpi, colormap, shade,
+                        shade_strength)
+        elif args.renderer == "stream":
+            save_png_stream(region.outfile, filepath, colormap, shade=shade,
+                            shade_strength=shade_strength)
+        else:
+            width, height = figure_size(region, width)
+            save_png(region.outfile, filepath, colormap,
+                     size=(int(round(width * dpi)), int(round(height * dpi))),
+                     shade=shade, shade_strength=shade_strength)
+        return filepath
+    finally:
+        region.close()
+
+
+def figure_size(region, width):
+    """Return the width and height in inches of an image of region that is
+    width inches wide."""
     if region.aspect_ratio < 0:
         height = width / region.aspect_ratio
     else:
         height = width * region.aspect_ratio
 
     height = height / region.distance_ratio  # correct for lng distance diff
+    return width, height
 
-    medfilt_filename_suffix = ""
-    if args.median_filter != '-1':
-        print "median filtering"
-        region.median_filter(kernel_size=int(args.median_filter))
-        medfilt_filename_suffix = "-medfilt_%s" % args.median_filter
+
+def save_figure(region, filepath, width=20, dpi=72, colormap="gray",
+                shade=None, shade_strength=0.5):
+    """Draw the map of region into an image of width inches and save it to
+    filepath, darkened by shade if given."""
+    width, height = figure_size(region, width)
 
     fig = plt.figure(frameon=False)
     fig.set_size_inches(width, height)
@@ -131,22 +270,159 @@ if __name__ == '__main__':
     # log_out = np.log1p(region.outfile)
 
     colormaps = [m for m in cm.datad if not m.endswith("_r")]
-    colormap = cm.get_cmap(args.color_map)
-    ax.imshow(region.outfile, aspect='normal', interpolation='bilinear',
-              cmap=colormap, alpha=1.0)
+    colormap = cm.get_cmap(colormap)
+    if shade is None:
+        ax.imshow(region.outfile, aspect='normal', interpolation='bilinear',
+                  cmap=colormap, alpha=1.0)
+    else:
+        ax.imshow(colorize(region.outfile, colormap, shade, shade_strength),
+                  aspect='normal', interpolation='bilinear', alpha=1.0)
 
-    name_source = ""  # append to filename either the source gpx or the bounds
-    if args.gpx_filename:
-        name_source = args.gpx_filename.split('/')[-1]
+    with instrument.span("encode", filepath=filepath):
+        fig.savefig(filepath)
+    plt.close(fig)  # batches draw many figures in one process
+
+
+def load_manifest(manifest_filepath, args):
+    """Read the jobs of a batch manifest. Returns a list of argparse
+    namespaces, one per job, with the options the job leaves out taken
+    from args."""
+    f = open(manifest_filepath, 'r')
+    try:
+        jobs = json.loads(f.read())
+    finally:
+        f.close()
+    if not isinstance(jobs, list):
+        raise ValueError('The batch manifest must hold a list of jobs.')
+
+    job_args = []
+    for i, job in enumerate(jobs):
+        options = dict(vars(args))
+        for key, value in job.items():
+            if key not in options or key.startswith('batch'):
+                raise ValueError('Unknown option %r in batch job %d.'
+                                 % (key, i))
+            options[key] = value
+        namespace = argparse.Namespace(**options)
+        try:
+            check_args(namespace)
+        except ValueError as e:
+            raise ValueError('Batch job %d: %s' % (i, e))
+        job_args.append(namespace)
+    return job_args
+
+
+def _cache_stats(srtm_managers):
+    hits = misses = 0
+    for srtm_manager in srtm_managers.values():
+        stats = srtm_manager.tile_cache.stats()
+        hits += stats["hits"]
+        misses += stats["misses"]
+    return hits, misses
+
+
+def run_job(job_number, args, srtm_managers):
+    """Render one batch job. Returns its summary: the image written, the
+    time taken and the tile cache hits and misses, or the error if it
+    failed."""
+    hits, misses = _cache_stats(srtm_managers)
+    summary = {"job": job_number, "gpx_filename": args.gpx_filename,
+               "bounds": args.bounds, "image": None, "error": None}
+    start = time.time()
+    try:
+        with instrument.span("render", job=job_number):
+            summary["image"] = render(args, srtm_managers)
+    except Exception as e:
+        logger.exception('Batch job %d failed', job_number)
+        summary["error"] = "%s: %s" % (type(e).__name__, e)
+    summary["seconds"] = round(time.time() - start, 3)
+    new_hits, new_misses = _cache_stats(srtm_managers)
+    summary["tile_cache_hits"] = new_hits - hits
+    summary["tile_cache_misses"] = new_misses - misses
+    return summary
+
+
+# SRTM managers of a batch worker process, shared by all its jobs
+_batch_managers = None
+
+
+def _init_batch_worker():
+    global _batch_managers
+    _batch_managers = {}
+
+
+def _run_batch_job(job):
+    job_number, args = job
+    return run_job(job_number, args, _batch_managers)
+
+
+def run_batch(job_args, batch_workers=1):
+    """Render all jobs in this process, or spread over batch_workers
+    processes. Either way every process keeps its SRTM managers warm from
+    one job to the next. Yields the summary of each job in order."""
+    jobs = list(enumerate(job_args))
+    if batch_workers > 1:
+        # pool processes can't start pools of their own
+        for job_number, args in jobs:
+            args.workers = 1
+        pool = multiprocessing.Pool(processes=batch_workers,
+                                    initializer=_init_batch_worker)
+        try:
+            for summary in pool.imap(_run_batch_job, jobs, 1):
+                yield summary
+        finally:
+            pool.close()
+            pool.join()
     else:
-        name_source = "%s,%sx%s,%s" % (
-            str(south_lat)[0:7], str(west_lng)[0:7],
-            str(north_lat)[0:7], str(east_lng)[0:7])
-
-    filename = "%s-%s-%s-%s%s%s_srtm%s.png" % (
-        datetime.datetime.strftime(datetime.datetime.now(),
-                                   "%y%m%d%H%M%S"),
-        resolution, colormap.name, name_source,
-        contour_filename_suffix, medfilt_filename_suffix,
-        str(args.srtm_format))
-    fig.savefig("images/%s" % filename)
+        srtm_managers = {}
+        for job_number, args in jobs:
+            yield run_job(job_number, args, srtm_managers)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.trace == '-':
+        instrument.enable(instrument.json_lines_sink(sys.stderr))
+    elif args.trace:
+        instrument.enable(instrument.json_lines_sink(open(args.trace, 'a')))
+
+    if not args.batch:
+        try:
+            check_args(args)
+        except ValueError as e:
+            parser.error(str(e))
+        with instrument.span("render"):
+            render(args)
+        return 0
+
+    try:
+        job_args = load_manifest(args.batch, args)
+    except (IOError, ValueError) as e:
+        parser.error(str(e))
+
+    summary_file = None
+    if args.batch_summary:
+        summary_file = open(args.batch_summary, 'w')
+    failed = 0
+    try:
+        for summary in run_batch(job_args, int(args.batch_workers)):
+            if summary["error"]:
+                failed += 1
+            print "job %d: %.1fs, tile cache %d hits / %d misses, %s" % (
+                summary["job"], summary["seconds"],
+                summary["tile_cache_hits"], summary["tile_cache_misses"],
+                summary["image"] or summary["error"])
+            if summary_file is not None:
+                summary_file.write(json.dumps(summary) + "\n")
+                summary_file.flush()
+    finally:
+        if summary_file is not None:
+            summary_file.close()
+    print "%d of %d jobs failed" % (failed, len(job_args))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+import numpy as np
+
+
+# mean earth radius used for all distances, in km
+EARTH_RADIUS_KM = 6367
+
+
+# http://stackoverflow.com/a/4913653/1145332
+# haversine formula for calculating distances between coordinates
+def haversine(lng1, lat1, lng2, lat2):
+    """
+    Calculate the great circle distance in km between two points on the
+    earth (specified in decimal degrees). The coordinates can be scalars or
+    arrays, arrays are paired up element by element.
+    """
+    # convert decimal degrees to radians
+    lng1, lat1, lng2, lat2 = map(np.radians, [lng1, lat1, lng2, lat2])
+    # haversine formula
+    dlon = lng2 - lng1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arcsin(np.sqrt(a))
+    return EARTH_RADIUS_KM * c
+
+
+def track_length(lngs, lats):
+    """Cumulative distance in km along a track, starting with 0 at the
+    first point.
+    """
+    lngs = np.asarray(lngs, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    distance = np.zeros(lats.size)
+    if lats.size > 1:
+        np.cumsum(haversine(lngs[:-1], lats[:-1], lngs[1:], lats[1:]),
+                  out=distance[1:])
+    return distance
+
+
+def distance_ratios(lats):
+    """The lng/lat distance ratio at each of the given latitudes, ie how
+    long a degree of longitude is compared to a degree of latitude.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lng_distance = haversine(0, lats, 1, lats)
+    lat_distance = haversine(0, lats, 0, lats - 1)
+    return lng_distance / lat_distance
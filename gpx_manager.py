@@ -1,8 +1,23 @@
 import os
+import array
+import collections
 
-import gpxpy
+import numpy as np
+from lxml import etree
 
-from util import haversine
+from geodesy import track_length
+
+
+# One track segment as arrays: latitudes and longitudes in degrees,
+# elevations in meters (NaN where missing) and datetime64 times (NaT where
+# missing).
+GPXSegment = collections.namedtuple(
+    'GPXSegment', ['lats', 'lons', 'elevations', 'times'])
+
+
+def _local_name(tag):
+    # strip the namespace, GPX 1.0 and 1.1 use different ones
+    return tag.rsplit('}', 1)[-1]
 
 
 class GPXManager:
@@ -13,12 +28,12 @@ class GPXManager:
         if not os.path.exists(gpx_filepath):
             raise ValueError("Invalid path to gpx file.")
 
-        gpx_file = open(gpx_filepath, 'r')
-        gpx = gpxpy.parse(gpx_file)
-        self.gpx = gpx
+        self.gpx_filepath = gpx_filepath
+        self._gpx = None
 
-        self.distance = []
-        self.elevation = []
+        self.segments = []
+        self.distance = np.zeros(0)
+        self.elevation = np.zeros(0)
 
         self.north_lat = -300
         self.west_lng = 300
@@ -27,36 +42,84 @@ class GPXManager:
 
         self.parse()
 
-    def _set_bounds(self, point):
-        if point.latitude > self.north_lat:
-            self.north_lat = point.latitude
-        if point.latitude < self.south_lat:
-            self.south_lat = point.latitude
-        if point.longitude > self.east_lng:
-            self.east_lng = point.longitude
-        if point.longitude < self.west_lng:
-            self.west_lng = point.longitude
+    @property
+    def gpx(self):
+        """The file parsed by gpxpy, for code that needs the object tree.
+        Parsed on first use."""
+        if self._gpx is None:
+            import gpxpy
+
+            gpx_file = open(self.gpx_filepath, 'r')
+            self._gpx = gpxpy.parse(gpx_file)
+            gpx_file.close()
+        return self._gpx
+
+    def _read_segments(self):
+        """Stream the track segments out of the file without building the
+        whole document tree. Elements are dropped as soon as they have been
+        read."""
+        lats = array.array('d')
+        lons = array.array('d')
+        elevations = array.array('d')
+        times = []
+
+        for _, element in etree.iterparse(self.gpx_filepath, events=('end',),
+                                          tag=('{*}trkpt', '{*}trkseg')):
+            if _local_name(element.tag) == 'trkpt':
+                lats.append(float(element.get('lat')))
+                lons.append(float(element.get('lon')))
+                elevation = np.nan
+                time = 'NaT'
+                for child in element:
+                    name = _local_name(child.tag)
+                    if name == 'ele' and child.text:
+                        elevation = float(child.text)
+                    elif name == 'time' and child.text:
+                        # numpy only parses times without a time zone
+                        time = child.text.strip().rstrip('Z')
+                elevations.append(elevation)
+                times.append(time)
+            else:
+                if lats:
+                    yield GPXSegment(
+                        np.frombuffer(lats, dtype=np.float64),
+                        np.frombuffer(lons, dtype=np.float64),
+                        np.frombuffer(elevations, dtype=np.float64),
+                        self._parse_times(times))
+                lats = array.array('d')
+                lons = array.array('d')
+                elevations = array.array('d')
+                times = []
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    @staticmethod
+    def _parse_times(times):
+        try:
+            return np.array(times, dtype='datetime64[ms]')
+        except ValueError:
+            # times with an offset or in a format numpy doesn't know
+            return np.array(['NaT'] * len(times), dtype='datetime64[ms]')
 
     def parse(self):
-        # returns ne, sw dictionary: {"ne": (x,y), "sw": (x,y)}
-
-        prev_point = None
-        distance = 0
-
-        for track in self.gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    self._set_bounds(point)
-                    if prev_point:
-                        distance += haversine(
-                            prev_point.longitude, prev_point.latitude,
-                            point.longitude, point.latitude)
-                        self.distance.append(distance)
-                    else:
-                        self.distance.append(0)
-                    self.elevation.append(point.elevation)
-
-                    prev_point = point
+        self.segments = list(self._read_segments())
+        if not self.segments:
+            return
+
+        lats = np.concatenate([segment.lats for segment in self.segments])
+        lons = np.concatenate([segment.lons for segment in self.segments])
+
+        self.north_lat = float(lats.max())
+        self.south_lat = float(lats.min())
+        self.east_lng = float(lons.max())
+        self.west_lng = float(lons.min())
+
+        # the distance runs on across segments
+        self.distance = track_length(lons, lats)
+        self.elevation = np.concatenate(
+            [segment.elevations for segment in self.segments])
 
     def get_boundaries(self):
         return {'ne': {'lat': self.north_lat, 'lng': self.east_lng},
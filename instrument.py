@@ -0,0 +1,152 @@
+"""Structured timing spans for the render pipeline.
+
+Spans are off until a sink is set with enable(). While disabled span()
+returns a shared no-op object, so instrumented code pays one function call.
+
+Sample calls:
+instrument.enable(instrument.json_lines_sink(open('trace.jsonl', 'w')))
+
+with instrument.span("contour", delta=100) as s:
+    ...
+    s.add(lines=12)
+
+Every finished span is passed to the sink as a dict with its name, wall
+time in seconds, bytes read from files, the process's peak resident memory
+and how much that peak grew during the span, plus its parent and any
+fields given to span() or add(). Span ids are unique per pid; worker
+processes forked inside a span report it as their parent.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import itertools
+
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+
+_sink = None
+_ids = itertools.count(1)
+_local = threading.local()
+
+
+def enable(sink):
+    """Send finished spans to sink, a callable taking the span dict."""
+    global _sink
+    _sink = sink
+
+
+def disable():
+    global _sink
+    _sink = None
+
+
+def enabled():
+    return _sink is not None
+
+
+def json_lines_sink(fileobj):
+    """Return a sink writing each span as a line of JSON to fileobj."""
+    lock = threading.Lock()
+
+    def sink(record):
+        line = json.dumps(record, sort_keys=True, default=str)
+        with lock:
+            fileobj.write(line + "\n")
+            fileobj.flush()
+    return sink
+
+
+def _bytes_read():
+    # bytes read by read() calls, linux only. Memory mapped tiles are not
+    # counted, their reads show up in the page cache instead.
+    try:
+        f = open('/proc/self/io', 'r')
+    except IOError:
+        return None
+    try:
+        for line in f:
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+    finally:
+        f.close()
+    return None
+
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024  # reported in bytes on macs
+    return peak
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, **fields):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Span:
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def add(self, **fields):
+        """Attach more fields to the span, eg. results known at the end."""
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.id = next(_ids)
+        self.parent = stack[-1].id if stack else None
+        stack.append(self)
+        self.start_bytes = _bytes_read()
+        self.start_peak = _peak_rss_kb()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.time() - self.start
+        end_bytes = _bytes_read()
+        end_peak = _peak_rss_kb()
+        _local.stack.pop()
+
+        record = dict(self.fields)
+        record.update({"span": self.name, "id": self.id,
+                       "parent": self.parent, "pid": os.getpid(),
+                       "start": self.start, "seconds": seconds,
+                       "peak_rss_kb": end_peak})
+        if end_bytes is not None and self.start_bytes is not None:
+            record["bytes_read"] = end_bytes - self.start_bytes
+        if end_peak is not None and self.start_peak is not None:
+            record["peak_rss_growth_kb"] = end_peak - self.start_peak
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+
+        sink = _sink
+        if sink is not None:
+            sink(record)
+        return False
+
+
+def span(name, **fields):
+    """Return a context manager timing the code it wraps as a span."""
+    if _sink is None:
+        return _null_span
+    return Span(name, fields)
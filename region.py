@@ -1,19 +1,28 @@
 import os
 import math
-import json
+import errno
+import hashlib
 
 from pylab import *
 
+import instrument
+import shading
+import cache_manager
+import region_cache
 from srtm import SRTMManager
+from region_index import RegionCacheIndex
 
-from util import haversine, bresenham_line, filled_circle, update_status
+from geodesy import haversine, distance_ratios
+from util import circle_footprint, line_pixels, update_status
 
 
 class Region:
     def __init__(self, north_lat, east_lng, south_lat, west_lng,
                  resolution=500, base_cache_dir='cache/parsed_data',
                  no_cache=False, padding_pct=20, srtm_format=1,
-                 patch_mode='auto', auto_parse=True):
+                 patch_mode='auto', auto_parse=True, srtm_manager=None,
+                 workers=1, out_of_core=False, chunk_rows=1024,
+                 use_overviews=True, incremental=False):
         self.north_lat = north_lat
         self.east_lng = east_lng
         self.south_lat = south_lat
@@ -27,8 +36,7 @@ class Region:
         self.valley = {"lat": None, "lng": None, "alt": 32767}
         self.resolution = resolution
         self.cache_dir = None
-        self.parsed_data_filepath = None
-        self.metadata_filepath = None
+        self.cache_filepath = None
         self.outfile = None
         self.distance_ratio = 1.0  # the lng/lat distance ratio of the region
         self.no_cache = no_cache
@@ -38,7 +46,26 @@ class Region:
 
         self.srtm_format = srtm_format
         self.patch_mode = patch_mode
-
+        self.srtm_manager = srtm_manager
+        self.workers = workers
+        # out of core regions keep outfile in a .npy memmap in cache_dir
+        # and process it chunk_rows rows at a time
+        self.out_of_core = out_of_core
+        self.chunk_rows = chunk_rows
+        # sample from downsampled tiles when the samples are far apart
+        self.use_overviews = use_overviews
+        self.overview_factor = 1
+        # kernel sizes outfile was median filtered with, in order, which
+        # grids derived from it are cached under
+        self.median_kernels = []
+        # reuse the overlap with a cached grid at the same intervals and
+        # only sample the rest, shifting the bounds by under half a sample
+        # to line up with it
+        self.incremental = incremental
+
+        self.base_cache_dir = base_cache_dir
+        # whether cache_dir is held against cache_manager evicting it
+        self.cache_held = False
         self._set_cache_filenames(base_cache_dir)
         self._setup_outfile()
         if auto_parse:
@@ -48,29 +75,55 @@ class Region:
                 self._load_cache()
 
     def _set_cache_filenames(self, base_cache_dir):
-        parsed_data_filename = "parsed_data.npy"
-        metadata_filename = "metadata.json"
-
         patch_mode_filename = ''
 
-        if self.patch_mode not in ['auto', 'reprocess']:
-            patch_mode_filename = '_patch_%s' % str(self.patch_mode)
+        if self.patch_mode_key != 'auto':
+            patch_mode_filename = '_patch_%s' % self.patch_mode_key
 
         self.cache_dir = os.path.join(
             base_cache_dir, "%s,%s_%s,%s_%s_srtm%s%s" % (
                 str(self.south_lat)[0:7], str(self.west_lng)[0:7],
                 str(self.north_lat)[0:7], str(self.east_lng)[0:7],
                 self.resolution, str(self.srtm_format), patch_mode_filename))
-        self.parsed_data_filepath = os.path.join(
-            self.cache_dir, parsed_data_filename)
-        self.metadata_filepath = os.path.join(
-            self.cache_dir, metadata_filename)
+        # the name is truncated for readability, when that is taken by a
+        # nearby region a digest of the full coordinates keeps them apart
+        if self._cache_collides():
+            digest = hashlib.sha1(repr((
+                self.south_lat, self.west_lng, self.north_lat, self.east_lng,
+                self.resolution, self.srtm_format, self.patch_mode_key,
+                self.use_overviews))).hexdigest()[0:10]
+            self.cache_dir += '_' + digest
+        self.cache_filepath = os.path.join(
+            self.cache_dir, region_cache.CACHE_FILENAME)
+
+    def _cache_collides(self):
+        """Whether cache_dir holds the grid of other bounds, or one sampled
+        from overviews when this region doesn't use them."""
+        metadata = region_cache.read_dir_metadata(self.cache_dir)
+        if metadata is None:
+            return False
+        if not self.use_overviews and metadata.get("overview_factor", 1) > 1:
+            return True
+        return (metadata.get("south_lat"), metadata.get("west_lng"),
+                metadata.get("north_lat"), metadata.get("east_lng"),
+                metadata.get("resolution")) != \
+            (self.south_lat, self.west_lng, self.north_lat, self.east_lng,
+             self.resolution)
+
+    @property
+    def patch_mode_key(self):
+        # auto and reprocess produce the same data
+        if self.patch_mode in ['auto', 'reprocess']:
+            return 'auto'
+        return str(self.patch_mode)
 
     def _save_cache(self):
         try:
             os.makedirs(self.cache_dir)
-        except:
-            pass
+        except OSError as e:
+            # another render of the same region may have created it
+            if e.errno != errno.EEXIST:
+                raise
 
         metadata = {
             "north_lat": self.north_lat,
@@ -92,12 +145,39 @@ class Region:
             "lat_km": self.lat_km,
             "lng_km": self.lng_km,
             "padding_pct": self.padding_pct,
-            "padding": self.padding
+            "padding": self.padding,
+            "srtm_format": self.srtm_format,
+            "patch_mode": self.patch_mode_key,
+            "overview_factor": self.overview_factor
         }
-        f = open(self.metadata_filepath, 'w')
-        f.write(json.dumps(metadata))
-        f.close()
-        np.save(self.parsed_data_filepath, self.outfile)
+        region_cache.write(self.cache_filepath, self.outfile, metadata)
+        if isinstance(self.outfile, np.memmap) and \
+                self.outfile.filename.endswith('.partial'):
+            # continue on the cache file, copy on write like a loaded cache
+            os.remove(self.outfile.filename)
+            self.outfile = region_cache.load(self.cache_filepath)[0]
+        RegionCacheIndex(self.base_cache_dir).add(self.cache_dir, metadata)
+        self._touch_cache(os.path.basename(self.cache_dir))
+
+    def _hold_cache(self):
+        """Keep cache_manager from evicting cache_dir until close()."""
+        if not self.cache_held:
+            cache_manager.hold(self.base_cache_dir,
+                               [os.path.basename(self.cache_dir)])
+            self.cache_held = True
+
+    def close(self):
+        """Let cache_manager evict cache_dir again."""
+        if self.cache_held:
+            cache_manager.release(self.base_cache_dir,
+                                  [os.path.basename(self.cache_dir)])
+            self.cache_held = False
+
+    def _touch_cache(self, name):
+        access_log = cache_manager.AccessLog(os.path.join(
+            self.base_cache_dir, cache_manager.ACCESS_FILENAME))
+        access_log.touch(name)
+        access_log.close()
 
     def _calculate_distance_ratio(self):
         # Latitude is a fairly consistent ~111km per parallel, whereas
@@ -110,16 +190,7 @@ class Region:
         # bad people. Okay, maybe they're not bad people, I just don't want to
         # check for this right now
         north_parallel = math.ceil(self.north_lat + 0.0001)
-        south_parallel = math.floor(self.north_lat + 0.0001)
-        west_meridian = math.ceil(self.east_lng + 0.0001)
-        east_meridian = math.floor(self.east_lng + 0.0001)
-
-        lat_distance = haversine(east_meridian, north_parallel,
-                                 east_meridian, south_parallel)
-        lng_distance = haversine(east_meridian, north_parallel,
-                                 west_meridian, north_parallel)
-
-        self.distance_ratio = lng_distance / lat_distance
+        self.distance_ratio = float(distance_ratios(north_parallel))
         return self.distance_ratio
 
     def _calculate_aspect_ratio(self):
@@ -137,10 +208,11 @@ class Region:
             "lng": self.east_lng + half_lng
         }
 
-        self.lat_km = haversine(self.midpoint["lng"], self.north_lat,
-                                self.midpoint["lng"], self.south_lat)
-        self.lng_km = haversine(self.west_lng, self.midpoint["lat"],
-                                self.east_lng, self.midpoint["lat"])
+        self.lat_km, self.lng_km = map(float, haversine(
+            [self.midpoint["lng"], self.west_lng],
+            [self.north_lat, self.midpoint["lat"]],
+            [self.midpoint["lng"], self.east_lng],
+            [self.south_lat, self.midpoint["lat"]]))
         return self.lat_km, self.lng_km
 
     def _add_coordinate_padding(self):
@@ -174,13 +246,171 @@ class Region:
 
         # numpy initizalizes the vertical as the first argument
         # ie zeros((8, 3)) is 8 tall by 3 wide
-        self.outfile = zeros((self.lat_sample_points, self.lng_sample_points))
+        if self.out_of_core:
+            # allocated on disk once we know we need it
+            self.outfile = None
+        else:
+            self.outfile = zeros((self.lat_sample_points,
+                                  self.lng_sample_points))
+
+    def _ensure_outfile(self):
+        if self.outfile is None:
+            self.outfile = self._new_grid(self.cache_filepath)
+
+    def _new_grid(self, filepath):
+        """Return a zeroed grid the size of outfile. Out of core this is a
+        memmap of filepath + '.partial', which _save_grid moves into place.
+        """
+        shape = (self.lat_sample_points, self.lng_sample_points)
+        if not self.out_of_core:
+            return zeros(shape)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        return np.lib.format.open_memmap(filepath + '.partial', mode='w+',
+                                         dtype=np.float64, shape=shape)
+
+    def _save_grid(self, grid, filepath):
+        """Save grid to filepath and return the grid to use from then on.
+        A memmap is reopened copy-on-write once moved into place, so
+        drawing on the result leaves the cached file alone."""
+        if isinstance(grid, np.memmap):
+            grid.flush()
+            os.rename(grid.filename, filepath)
+            return self._load_grid(filepath)
+        np.save(filepath, grid)
+        return grid
+
+    def _load_grid(self, filepath):
+        if self.out_of_core:
+            # copy on write, so drawing on the grid leaves the cache alone
+            return np.load(filepath, mmap_mode='c')
+        return np.load(filepath)
+
+    def _row_windows(self):
+        """Yield slices covering the rows of outfile, chunk_rows at a time.
+        """
+        nrows = self.lat_sample_points
+        for start in range(0, nrows, self.chunk_rows):
+            yield slice(start, min(start + self.chunk_rows, nrows))
+
+    def _get_srtm_manager(self):
+        if self.srtm_manager is None:
+            self.srtm_manager = SRTMManager(srtm_format=self.srtm_format,
+                                            patch_mode=self.patch_mode)
+        return self.srtm_manager
+
+    def footprint_tiles(self):
+        """Return the (lat, lon) of every SRTM tile the padded bounds
+        touch."""
+        return self._tiles_between(self.south_lat, self.west_lng,
+                                   self.north_lat, self.east_lng)
+
+    @staticmethod
+    def _tiles_between(south_lat, west_lng, north_lat, east_lng):
+        south, west = SRTMManager.tile_key(south_lat, west_lng)
+        north, east = SRTMManager.tile_key(north_lat, east_lng)
+        return [(lat, lng) for lat in range(south, north + 1)
+                for lng in range(west, east + 1)]
+
+    def prefetch_tiles(self):
+        """Fetch, download and patch every tile in the footprint up front,
+        using self.workers processes."""
+        self._get_srtm_manager().prefetch(self.footprint_tiles(),
+                                          workers=self.workers)
+
+    def _overlay_map(self, scalar=False, strip_rows=256):
+        self._ensure_outfile()
+        if scalar:
+            return self._overlay_map_scalar()
 
-    def _overlay_map(self):
         print "\noverlaying relief map\n"
 
-        srtm = SRTMManager(srtm_format=self.srtm_format,
-                           patch_mode=self.patch_mode)
+        srtm = self._get_srtm_manager()
+        self.overview_factor = self._sampling_factor()
+
+        tiles = self.footprint_tiles()
+        if self.overview_factor > 1:
+            tiles += [tile + (self.overview_factor,) for tile in tiles]
+        srtm.pin_tiles(tiles)
+        try:
+            self.prefetch_tiles()
+            self._sample_map(srtm, strip_rows)
+        finally:
+            srtm.unpin_tiles(tiles)
+        self._save_cache()
+
+    def _sampling_factor(self):
+        """The overview factor to sample the tiles at."""
+        if not self.use_overviews:
+            return 1
+        return self._get_srtm_manager().overview_factor(
+            min(self.lat_interval, self.lng_interval))
+
+    def _sample_map(self, srtm, strip_rows):
+        # same sample points as the scalar loop, which skips the first row
+        # and column of the grid
+        ys = np.arange(1, self.lat_sample_points)
+        xs = np.arange(1, self.lng_sample_points)
+        sample_lngs = self.west_lng + xs * self.lng_interval
+
+        strips = [ys[start:start + strip_rows]
+                  for start in range(0, ys.size, strip_rows)]
+        blocks = [(self.south_lat + strip_ys * self.lat_interval, sample_lngs)
+                  for strip_ys in strips]
+
+        # strips come back in order, so peak and valley are merged the same
+        # way no matter how many workers sampled them
+        sampled = 0
+        with instrument.span("sample", rows=ys.size, cols=xs.size,
+                             factor=self.overview_factor,
+                             workers=self.workers):
+            for strip_ys, (sample_lats, _), alts in zip(
+                    strips, blocks,
+                    srtm.get_altitude_grids(blocks, workers=self.workers,
+                                            factor=self.overview_factor)):
+                self._write_samples(strip_ys, alts)
+                self._update_extremes(alts, sample_lats, sample_lngs)
+                sampled += strip_ys.size
+                update_status(100.0 * sampled / ys.size)
+
+    def _write_samples(self, ys, alts, x_start=1):
+        """Write a block of sampled rows into outfile, from column x_start,
+        skipping the samples the scalar loop would skip (voids and zeros).
+        """
+        rows = self.lat_sample_points - ys
+        cols = slice(x_start, x_start + alts.shape[1])
+        valid = ~np.isnan(alts) & (alts != 0)
+        self.outfile[rows, cols] = np.where(valid, alts,
+                                            self.outfile[rows, cols])
+
+    def _update_extremes(self, alts, sample_lats, sample_lngs):
+        """Update peak and valley from a block of samples. Rows of alts are
+        in sampling order, so argmax/argmin pick the same sample the scalar
+        loop would have.
+        """
+        valid = ~np.isnan(alts) & (alts != 0)
+        if not valid.any():
+            return
+        ncols = alts.shape[1]
+
+        highs = np.where(valid, alts, -np.inf)
+        i = np.argmax(highs)
+        if highs.flat[i] > self.peak["alt"]:
+            self.peak["alt"] = float(highs.flat[i])
+            self.peak["lat"] = float(sample_lats[i // ncols])
+            self.peak["lng"] = float(sample_lngs[i % ncols])
+
+        lows = np.where(valid, alts, np.inf)
+        i = np.argmin(lows)
+        if lows.flat[i] < self.valley["alt"]:
+            self.valley["alt"] = float(lows.flat[i])
+            self.valley["lat"] = float(sample_lats[i // ncols])
+            self.valley["lng"] = float(sample_lngs[i % ncols])
+
+    def _overlay_map_scalar(self):
+        print "\noverlaying relief map\n"
+
+        srtm = self._get_srtm_manager()
 
         c = 0  # just a counter to track completion
         total_samples = self.lng_sample_points * self.lat_sample_points
@@ -208,114 +438,521 @@ class Region:
 
     def contour(self, contour_delta=50):
         print "\ncontouring\n"
-        contoured_data_filepath = os.path.join(
-            self.cache_dir, 'contour-%s.npy' % contour_delta)
-
-        if self.no_cache or not os.path.exists(contoured_data_filepath):
-            alt_range = self.peak["alt"] - self.valley["alt"]
-            steps = math.ceil(alt_range / contour_delta)
-            grey_delta = alt_range / steps
-
-            for (x, y), value in np.ndenumerate(self.outfile):
-                countour_interval = math.floor(value / contour_delta)
-                new_shade = int(math.floor(countour_interval * grey_delta))
-                self.outfile[x][y] = new_shade
-            np.save(contoured_data_filepath, self.outfile)
-        else:
-            self.outfile = np.load(contoured_data_filepath)
+        self.outfile = self.contours([contour_delta])[contour_delta]
+
+    def contours(self, contour_deltas):
+        """Quantize outfile at each contour interval in contour_deltas.
+
+        Returns a dict of contour delta to contoured grid, each cached as
+        contour-<delta>.npy in cache_dir, or contour-<delta>-medfilt<k>.npy
+        once outfile was median filtered. outfile itself is left alone, so
+        any number of intervals can be made from one loaded grid.
+        """
+        contoured = {}
+        for contour_delta in contour_deltas:
+            contoured_data_filepath = os.path.join(
+                self.cache_dir, 'contour-%s%s.npy' % (
+                    contour_delta, self._filter_suffix()))
+
+            if self.no_cache or not os.path.exists(contoured_data_filepath):
+                contoured[contour_delta] = self._contour_grid(
+                    contour_delta, contoured_data_filepath)
+            else:
+                contoured[contour_delta] = self._load_grid(
+                    contoured_data_filepath)
+        return contoured
+
+    def _contour_grid(self, contour_delta, filepath):
+        alt_range = self.peak["alt"] - self.valley["alt"]
+        steps = math.ceil(alt_range / contour_delta)
+        grey_delta = alt_range / steps
+
+        with instrument.span("contour", delta=contour_delta):
+            contoured = self._new_grid(filepath)
+            for rows in self._row_windows():
+                countour_intervals = np.floor(self.outfile[rows] /
+                                              contour_delta)
+                contoured[rows] = np.floor(countour_intervals * grey_delta)
+            contoured = self._save_grid(contoured, filepath)
+        return contoured
+
+    def hillshade(self, azimuths=shading.DEFAULT_AZIMUTHS,
+                  altitude=shading.DEFAULT_ALTITUDE, z_factor=1.0):
+        """Shade outfile lit from each of azimuths (degrees clockwise from
+        north) at altitude degrees. Returns a grid from 0 (dark) to 1 (lit),
+        cached as hillshade-<altitude>-<azimuths>-<z_factor>.npy in
+        cache_dir.
+        """
+        filepath = os.path.join(self.cache_dir, 'hillshade-%s-%s-%s%s.npy' % (
+            altitude, '_'.join(str(a) for a in azimuths), z_factor,
+            self._filter_suffix()))
+        if not self.no_cache and os.path.exists(filepath):
+            return self._load_grid(filepath)
+
+        with instrument.span("hillshade", azimuths=list(azimuths),
+                             altitude=altitude):
+            shaded = self._new_grid(filepath)
+            for rows, dzdx, dzdy in self._gradients():
+                shaded[rows] = shading.hillshade(dzdx, dzdy, azimuths,
+                                                 altitude, z_factor)
+            shaded = self._save_grid(shaded, filepath)
+        return shaded
+
+    def slope(self, z_factor=1.0):
+        """Return the slope of outfile in degrees, cached as
+        slope-<z_factor>.npy in cache_dir."""
+        filepath = os.path.join(self.cache_dir, 'slope-%s%s.npy' % (
+            z_factor, self._filter_suffix()))
+        if not self.no_cache and os.path.exists(filepath):
+            return self._load_grid(filepath)
+
+        with instrument.span("slope"):
+            slopes = self._new_grid(filepath)
+            for rows, dzdx, dzdy in self._gradients():
+                slopes[rows] = shading.slope(dzdx, dzdy, z_factor)
+            slopes = self._save_grid(slopes, filepath)
+        return slopes
+
+    def _pixel_spacing(self):
+        """Return the metres between columns for every row of outfile, and
+        between rows. Columns get closer together towards the poles."""
+        rows = np.arange(self.lat_sample_points)
+        row_lats = self.south_lat + \
+            (self.lat_sample_points - rows) * self.lat_interval
+        dy = self.lat_km * 1000 / self.lat_delta * self.lat_interval
+        dx = self.lng_km * 1000 / self.lng_delta * self.lng_interval * \
+            distance_ratios(row_lats) / distance_ratios(self.midpoint["lat"])
+        return dx, dy
+
+    def _gradients(self):
+        """Yield each window of rows of outfile with the east and north
+        gradients of its rows."""
+        nrows = self.lat_sample_points
+        dx, dy = self._pixel_spacing()
+        for rows in self._row_windows():
+            # one row above and below for the 3x3 kernel
+            top = max(rows.start - 1, 0)
+            bottom = min(rows.stop + 1, nrows)
+            window = np.array(self.outfile[top:bottom], dtype=np.float64)
+            # the first row and column are never sampled, give them the
+            # slope of their neighbours
+            if top == 0 and window.shape[0] > 1:
+                window[0] = window[1]
+            if window.shape[1] > 1:
+                window[:, 0] = window[:, 1]
+            window = shading.pad_edges(window, rows.start == 0,
+                                       rows.stop == nrows)
+            dzdx, dzdy = shading.gradient(window, dx[rows], dy)
+            yield rows, dzdx, dzdy
 
     def median_filter(self, kernel_size=3):
+        with instrument.span("median_filter", kernel_size=kernel_size):
+            self._median_filter(kernel_size)
+
+    def _median_filter(self, kernel_size):
         from scipy import signal
 
-        self.outfile = signal.medfilt2d(self.outfile, kernel_size=kernel_size)
-
-    def overlay_map(self):
-        if os.path.exists(self.cache_dir):
-            self.outfile = np.load(self.parsed_data_filepath)
-
-            f = open(self.metadata_filepath, 'r')
-            metadata = json.loads(f.read())
-            f.close()
-
-            self.north_lat = metadata["north_lat"]
-            self.east_lng = metadata["east_lng"]
-            self.south_lat = metadata["south_lat"]
-            self.west_lng = metadata["west_lng"]
-            self.peak = metadata["peak"]
-            self.valley = metadata["valley"]
-            self.resolution = metadata["resolution"]
-            self.aspect_ratio = metadata["aspect_ratio"]
-            self.distance_ratio = metadata["distance_ratio"]
-            self.lat_delta = metadata["lat_delta"]
-            self.lng_delta = metadata["lng_delta"]
-            self.lng_sample_points = metadata["lng_sample_points"]
-            self.lat_sample_points = metadata["lat_sample_points"]
-            self.lng_interval = metadata["lng_interval"]
-            self.lat_interval = metadata["lat_interval"]
-            self.midpoint = metadata["midpoint"]
-            self.lat_km = metadata["lat_km"]
-            self.lng_km = metadata["lng_km"]
-            self.padding_pct = metadata["padding_pct"]
-            self.padding = metadata["padding"]
-        else:
-            self._overlay_map()
+        self.median_kernels.append(kernel_size)
+        if not self.out_of_core:
+            self.outfile = signal.medfilt2d(self.outfile,
+                                            kernel_size=kernel_size)
+            return
+
+        # filter each window with enough rows around it that the result is
+        # the same as filtering the whole grid at once
+        halo = kernel_size // 2
+        nrows = self.lat_sample_points
+        filtered = self._new_grid(
+            os.path.join(self.cache_dir, 'medfilt-%s' % kernel_size))
+        for rows in self._row_windows():
+            top = max(rows.start - halo, 0)
+            bottom = min(rows.stop + halo, nrows)
+            window = signal.medfilt2d(np.asarray(self.outfile[top:bottom]),
+                                      kernel_size=kernel_size)
+            filtered[rows] = window[rows.start - top:rows.stop - top]
+        filtered.flush()
+        # a scratch file, the memmap stays readable once it is removed
+        os.remove(filtered.filename)
+        self.outfile = filtered
+
+    def _filter_suffix(self):
+        """The part of the cache filenames of grids derived from outfile
+        saying how it was median filtered."""
+        return ''.join('-medfilt%s' % k for k in self.median_kernels)
+
+    def overlay_map(self, scalar=False):
+        self._hold_cache()
+        if self._load_cache():
+            return
+        if not self.no_cache and not scalar:
+            covering = self._find_covering_cache()
+            if covering:
+                self._resample_cached(*covering)
+                return
+            if self.incremental:
+                overlapping = self._find_overlapping_cache()
+                if overlapping is not None:
+                    self._snap_to_cache(overlapping[1])
+                    # the shifted bounds may have been rendered before
+                    if not self._load_cache():
+                        self._overlay_incremental(*overlapping)
+                    return
+        self._overlay_map(scalar=scalar)
+
+    def _load_cache(self):
+        """Load outfile and the metadata from cache_dir, which also reads
+        caches written by older versions. Returns whether there was a
+        usable cache."""
+        try:
+            self.outfile, metadata = region_cache.load_dir(self.cache_dir)
+        except (IOError, ValueError, region_cache.RegionCacheError):
+            return False
+        self._touch_cache(os.path.basename(self.cache_dir))
+
+        self.north_lat = metadata["north_lat"]
+        self.east_lng = metadata["east_lng"]
+        self.south_lat = metadata["south_lat"]
+        self.west_lng = metadata["west_lng"]
+        self.peak = metadata["peak"]
+        self.valley = metadata["valley"]
+        self.resolution = metadata["resolution"]
+        self.aspect_ratio = metadata["aspect_ratio"]
+        self.distance_ratio = metadata["distance_ratio"]
+        self.lat_delta = metadata["lat_delta"]
+        self.lng_delta = metadata["lng_delta"]
+        self.lng_sample_points = metadata["lng_sample_points"]
+        self.lat_sample_points = metadata["lat_sample_points"]
+        self.lng_interval = metadata["lng_interval"]
+        self.lat_interval = metadata["lat_interval"]
+        self.midpoint = metadata["midpoint"]
+        self.lat_km = metadata["lat_km"]
+        self.lng_km = metadata["lng_km"]
+        self.padding_pct = metadata["padding_pct"]
+        self.padding = metadata["padding"]
+        self.overview_factor = metadata.get("overview_factor", 1)
+        return True
+
+    def _find_covering_cache(self):
+        """Return (name, index entry) of a cached region that covers every
+        sample point of this one at the same or a higher density, and
+        sampled from overviews no coarser than this one would be."""
+        index = RegionCacheIndex(self.base_cache_dir)
+        return index.find_covering(
+            self.south_lat + self.lat_interval,
+            self.west_lng + self.lng_interval,
+            self.south_lat + (self.lat_sample_points - 1) * self.lat_interval,
+            self.west_lng + (self.lng_sample_points - 1) * self.lng_interval,
+            self.lat_interval, self.lng_interval, self.srtm_format,
+            self.patch_mode_key, self._sampling_factor())
+
+    def _resample_cached(self, name, entry):
+        """Fill outfile by cropping or resampling a cached grid instead of
+        going back to the SRTM tiles."""
+        print "\nresampling cached region %s\n" % name
+        self._ensure_outfile()
+        self._touch_cache(name)
+        # the map keeps the data readable even if the cache is evicted now
+        cached = region_cache.load_dir(os.path.join(self.base_cache_dir,
+                                                    name), mode='r')[0]
+
+        ys = np.arange(1, self.lat_sample_points)
+        xs = np.arange(1, self.lng_sample_points)
+        sample_lngs = self.west_lng + xs * self.lng_interval
+        cols = (sample_lngs - entry["west_lng"]) / entry["lng_interval"]
+
+        for start in range(0, ys.size, self.chunk_rows):
+            strip_ys = ys[start:start + self.chunk_rows]
+            sample_lats = self.south_lat + strip_ys * self.lat_interval
+            rows = entry["lat_sample_points"] - \
+                (sample_lats - entry["south_lat"]) / entry["lat_interval"]
+            alts = self._interpolate_grid(cached, rows, cols)
+            self._write_samples(strip_ys, alts)
+            self._update_extremes(alts, sample_lats, sample_lngs)
+        # the samples are no finer than the overviews they came from
+        self.overview_factor = entry["overview_factor"]
+        self._save_cache()
+
+    def _cache_offsets(self, entry):
+        """Return how many samples the cached grid of entry is offset from
+        this region, north and east, and the fractions of a sample left
+        over."""
+        rows = (self.south_lat - entry["south_lat"]) / self.lat_interval
+        cols = (self.west_lng - entry["west_lng"]) / self.lng_interval
+        row_offset = int(round(rows))
+        col_offset = int(round(cols))
+        return row_offset, col_offset, rows - row_offset, cols - col_offset
+
+    def _cache_overlap(self, entry):
+        """Return the first and last ys and xs of our sample points that
+        the cached grid of entry has samples for, or None."""
+        row_offset, col_offset = self._cache_offsets(entry)[:2]
+        # a sample (y, x) of ours is (y + row_offset, x + col_offset) in
+        # the cached grid, whose row 0 and column 0 are never sampled
+        y0 = max(1, 1 - row_offset)
+        y1 = min(self.lat_sample_points - 1,
+                 entry["lat_sample_points"] - 1 - row_offset)
+        x0 = max(1, 1 - col_offset)
+        x1 = min(self.lng_sample_points - 1,
+                 entry["lng_sample_points"] - 1 - col_offset)
+        if y0 > y1 or x0 > x1:
+            return None
+        return y0, y1, x0, x1
+
+    def _find_overlapping_cache(self):
+        """Return (name, index entry) of the cached grid sampled at the
+        same intervals and overview factor as this region that shares the
+        most sample points with it, or None."""
+        index = RegionCacheIndex(self.base_cache_dir)
+        best = None
+        for name, entry in index.find_overlapping(
+                self.south_lat + self.lat_interval,
+                self.west_lng + self.lng_interval,
+                self.south_lat +
+                (self.lat_sample_points - 1) * self.lat_interval,
+                self.west_lng +
+                (self.lng_sample_points - 1) * self.lng_interval,
+                self.lat_interval, self.lng_interval, self.srtm_format,
+                self.patch_mode_key, self._sampling_factor()):
+            overlap = self._cache_overlap(entry)
+            if overlap is None:
+                continue
+            y0, y1, x0, x1 = overlap
+            shared = (y1 - y0 + 1) * (x1 - x0 + 1)
+            if best is None or shared > best[0]:
+                best = (shared, name, entry)
+        if best is None:
+            return None
+        return best[1:]
+
+    def _snap_to_cache(self, entry):
+        """Shift the bounds by under half a sample so the sample points
+        fall on those of the cached grid of entry, and move to the cache
+        dir of the shifted bounds."""
+        row_fraction, col_fraction = self._cache_offsets(entry)[2:]
+        if row_fraction == 0 and col_fraction == 0:
+            return
+        lat_shift = -row_fraction * self.lat_interval
+        lng_shift = -col_fraction * self.lng_interval
+        self.close()
+        self.north_lat += lat_shift
+        self.south_lat += lat_shift
+        self.east_lng += lng_shift
+        self.west_lng += lng_shift
+        self._calculate_distance_ratio()
+        self._calculate_area_size()
+        self._set_cache_filenames(self.base_cache_dir)
+        self._hold_cache()
+
+    def _overlay_incremental(self, name, entry, strip_rows=256):
+        """Fill outfile by copying the samples the cached grid of entry
+        shares with it and sampling only the rest from the SRTM tiles."""
+        print "\nextending cached region %s\n" % name
+        self._ensure_outfile()
+        self._touch_cache(name)
+        # the map keeps the data readable even if the cache is evicted now
+        cached = region_cache.load_dir(os.path.join(self.base_cache_dir,
+                                                    name), mode='r')[0]
+        row_offset, col_offset = self._cache_offsets(entry)[:2]
+        y0, y1, x0, x1 = self._cache_overlap(entry)
+        nrows = self.lat_sample_points
+        cached_rows = entry["lat_sample_points"]
+
+        with instrument.span("copy_overlap", rows=y1 - y0 + 1,
+                             cols=x1 - x0 + 1):
+            for start in range(y0, y1 + 1, self.chunk_rows):
+                stop = min(start + self.chunk_rows, y1 + 1)
+                # ys start to stop - 1, north first like the grids
+                self.outfile[nrows - stop + 1:nrows - start + 1,
+                             x0:x1 + 1] = \
+                    cached[cached_rows - row_offset - stop + 1:
+                           cached_rows - row_offset - start + 1,
+                           x0 + col_offset:x1 + col_offset + 1]
+
+        # the samples the cached grid lacks: whole rows above and below
+        # the overlap, and the columns either side of it in between
+        ys = np.arange(1, nrows)
+        xs = np.arange(1, self.lng_sample_points)
+        pieces = []
+        for rows, cols in [(ys[ys < y0], xs), (ys[ys > y1], xs),
+                           (ys[(ys >= y0) & (ys <= y1)], xs[xs < x0]),
+                           (ys[(ys >= y0) & (ys <= y1)], xs[xs > x1])]:
+            if cols.size == 0:
+                continue
+            for start in range(0, rows.size, strip_rows):
+                pieces.append((rows[start:start + strip_rows], cols))
+        blocks = [(self.south_lat + strip_ys * self.lat_interval,
+                   self.west_lng + strip_xs * self.lng_interval)
+                  for strip_ys, strip_xs in pieces]
+
+        srtm = self._get_srtm_manager()
+        self.overview_factor = self._sampling_factor()
+        tiles = set()
+        for lats, lngs in blocks:
+            tiles.update(self._tiles_between(lats.min(), lngs.min(),
+                                             lats.max(), lngs.max()))
+        tiles = sorted(tiles)
+        if self.overview_factor > 1:
+            tiles += [tile + (self.overview_factor,) for tile in tiles]
+
+        total = sum(strip_ys.size * strip_xs.size
+                    for strip_ys, strip_xs in pieces)
+        sampled = 0
+        srtm.pin_tiles(tiles)
+        try:
+            srtm.prefetch(tiles, workers=self.workers)
+            with instrument.span("sample", samples=total,
+                                 factor=self.overview_factor,
+                                 workers=self.workers, incremental=True):
+                for (strip_ys, strip_xs), alts in zip(
+                        pieces, srtm.get_altitude_grids(
+                            blocks, workers=self.workers,
+                            factor=self.overview_factor)):
+                    self._write_samples(strip_ys, alts, strip_xs[0])
+                    sampled += alts.size
+                    update_status(100.0 * sampled / max(total, 1))
+        finally:
+            srtm.unpin_tiles(tiles)
+
+        # peak and valley of the whole new window, in sampling order
+        self.peak = {"lat": None, "lng": None, "alt": 0}
+        self.valley = {"lat": None, "lng": None, "alt": 32767}
+        sample_lngs = self.west_lng + xs * self.lng_interval
+        for start in range(0, ys.size, self.chunk_rows):
+            strip_ys = ys[start:start + self.chunk_rows]
+            self._update_extremes(
+                np.asarray(self.outfile[nrows - strip_ys, 1:]),
+                self.south_lat + strip_ys * self.lat_interval, sample_lngs)
+        self._save_cache()
 
-    def overlay_gps(self, gpx, thickness=2, elevation_delta=20):
+    @staticmethod
+    def _interpolate_grid(grid, rows, cols):
+        """Bilinear interpolation of grid at every combination of the
+        fractional rows and cols. Positions within 1e-6 of a whole pixel are
+        snapped to it, so aligned grids are copied exactly. Where one of the
+        four pixels has no data (0) the nearest pixel is used instead.
+        """
+        def split(positions, size):
+            nearest = np.round(positions)
+            positions = np.where(abs(positions - nearest) < 1e-6, nearest,
+                                 positions)
+            low = np.clip(np.floor(positions).astype(np.intp), 0, size - 1)
+            high = np.clip(low + 1, 0, size - 1)
+            return low, high, positions - low
+
+        row0, row1, row_weight = split(rows, grid.shape[0])
+        col0, col1, col_weight = split(cols, grid.shape[1])
+        row_weight = row_weight[:, np.newaxis]
+
+        value00 = grid[np.ix_(row0, col0)]
+        value01 = grid[np.ix_(row0, col1)]
+        value10 = grid[np.ix_(row1, col0)]
+        value11 = grid[np.ix_(row1, col1)]
+
+        value = (value00 * (1 - col_weight) + value01 * col_weight) * \
+            (1 - row_weight) + \
+            (value10 * (1 - col_weight) + value11 * col_weight) * row_weight
+
+        no_data = (value00 == 0) | (value01 == 0) | (value10 == 0) | \
+            (value11 == 0)
+        nearest = grid[np.ix_(np.where(row_weight[:, 0] < 0.5, row0, row1),
+                              np.where(col_weight < 0.5, col0, col1))]
+        return np.where(no_data, nearest, value)
+
+    def overlay_gps(self, segments, thickness=2, elevation_delta=20):
+        """Draw a track onto the map. segments is a list of GPXSegment
+        arrays, or a GPXManager or gpxpy object to take them from.
+        """
+        with instrument.span("overlay_gps", thickness=thickness):
+            self._overlay_gps(segments, thickness, elevation_delta)
+
+    def _overlay_gps(self, segments, thickness, elevation_delta):
         print "\noverlaying gps\n"
-        srtm = SRTMManager(srtm_format=self.srtm_format,
-                           patch_mode=self.patch_mode)
-
-        prev_pixel = None
-        prev_alt = 0
-
-        # get a circle to draw at every point
-        circ = filled_circle(int(thickness))
-
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    p_lat, p_lng = point.latitude, point.longitude
-
-                    alt = srtm.get_altitude(p_lat, p_lng)
-
-                    if not alt:
-                        alt = prev_alt
-                    else:
-                        prev_alt = alt
-
-                    # we need to get the percentage of the map where the
-                    # point is and convert it to number of pixels
-                    lat_pt = abs(p_lat - self.south_lat)
-                    lng_pt = abs(self.east_lng - p_lng)
-
-                    if lat_pt < self.lat_delta and lng_pt < self.lng_delta:
-                        lat_pct = lat_pt / self.lat_delta
-                        lng_pct = lng_pt / self.lng_delta
-                        pixel_lat = int(math.floor(lat_pct *
-                                        self.lat_sample_points))
-                        pixel_lng = int(math.floor(lng_pct *
-                                        self.lng_sample_points))
-
-                        # draw a line between the pixels
-                        if prev_pixel:
-                            coords = bresenham_line(
-                                (pixel_lat, pixel_lng),
-                                (prev_pixel['lat'], prev_pixel['lng']))
-                            for pixel in coords:
-                                x, y = pixel
-
-                                pixel_y = self.lat_sample_points - x
-                                pixel_x = self.lng_sample_points - y
-
-                                for point in circ:
-                                    x, y = point
-                                    circ_x = pixel_x + x
-                                    circ_y = pixel_y + y
-                                    if circ_x >= self.lng_sample_points:
-                                        circ_x = self.lng_sample_points - 1
-                                    if circ_y >= self.lat_sample_points:
-                                        circ_y = self.lat_sample_points - 1
-                                    self.outfile[circ_y, circ_x] = alt + \
-                                        int(elevation_delta)
-
-                        prev_pixel = {'lat': pixel_lat, 'lng': pixel_lng}
+        srtm = self._get_srtm_manager()
+        self._ensure_outfile()
+
+        lats, lngs = self._track_points(segments)
+        if not lats.size:
+            return
+
+        # points without an altitude take the one of the point before
+        alts = srtm.get_altitudes(lats, lngs, nodata=0)
+        known = np.where(alts != 0, np.arange(alts.size), 0)
+        alts = alts[np.maximum.accumulate(known)]
+
+        # we need to get the percentage of the map where the
+        # point is and convert it to number of pixels
+        lat_pts = abs(lats - self.south_lat)
+        lng_pts = abs(self.east_lng - lngs)
+        inside = (lat_pts < self.lat_delta) & (lng_pts < self.lng_delta)
+        pixel_lats = np.floor(lat_pts[inside] / self.lat_delta *
+                              self.lat_sample_points).astype(np.intp)
+        pixel_lngs = np.floor(lng_pts[inside] / self.lng_delta *
+                              self.lng_sample_points).astype(np.intp)
+        if pixel_lats.size < 2:
+            return
+
+        # draw a line between consecutive points, at the altitude of the
+        # later point, and from it back to the one before as the pixels of
+        # a line depend on its direction
+        rows = self.lat_sample_points - pixel_lats
+        cols = self.lng_sample_points - pixel_lngs
+        line_rows, line_cols, lines = line_pixels(rows[1:], cols[1:],
+                                                  rows[:-1], cols[:-1])
+        self._stamp_lines(line_rows, line_cols, lines,
+                          alts[inside][1:] + int(elevation_delta),
+                          circle_footprint(int(thickness)))
+
+    @staticmethod
+    def _track_points(segments):
+        """Return the latitudes and longitudes of all points of a track."""
+        if hasattr(segments, 'tracks'):
+            # a gpxpy object
+            points = [(point.latitude, point.longitude)
+                      for track in segments.tracks
+                      for segment in track.segments
+                      for point in segment.points]
+            return np.array(points, dtype=np.float64).reshape(-1, 2).T
+        segments = getattr(segments, 'segments', segments)
+        if not segments:
+            return np.zeros(0), np.zeros(0)
+        return (np.concatenate([segment.lats for segment in segments]),
+                np.concatenate([segment.lons for segment in segments]))
+
+    def _stamp_lines(self, rows, cols, lines, values, footprint):
+        """Draw the footprint around every line pixel into outfile, with the
+        value of its line. Where lines overlap the later line wins.
+
+        The track is small next to the map, so it is dilated as a sparse set
+        of pixels: every pixel is moved by every footprint offset, only the
+        latest line is kept for each pixel covered, and outfile gets one
+        assignment.
+        """
+        nrows, ncols = self.outfile.shape
+        radius = footprint.shape[0] // 2
+        offset_rows, offset_cols = np.nonzero(footprint)
+
+        # pixels drawn by several lines only need to be stamped once
+        rows, cols, lines = self._latest_lines(rows, cols, lines)
+
+        # as when outfile was drawn pixel by pixel, offsets past the last
+        # row and column are drawn on them and ones before the first wrap
+        # around like negative indices
+        rows = (np.minimum(rows[:, np.newaxis] + (offset_rows - radius),
+                           nrows - 1) % nrows).ravel()
+        cols = (np.minimum(cols[:, np.newaxis] + (offset_cols - radius),
+                           ncols - 1) % ncols).ravel()
+        lines = np.repeat(lines, offset_rows.size)
+        rows, cols, lines = self._latest_lines(rows, cols, lines)
+
+        self.outfile[rows, cols] = values[lines]
+
+    @staticmethod
+    def _latest_lines(rows, cols, lines):
+        """Drop all but the highest line index drawn at each pixel."""
+        if not rows.size:
+            return rows, cols, lines
+        pixels = rows.astype(np.int64) * (cols.max() + 1) + cols
+        order = np.argsort(pixels * (lines.max() + 1) + lines)
+        pixels = pixels[order]
+        latest = order[np.r_[pixels[1:] != pixels[:-1], True]]
+        return rows[latest], cols[latest], lines[latest]
@@ -0,0 +1,139 @@
+"""The file a Region caches its sampled grid in.
+
+A region cache file is a 4096 byte header followed by the grid as little
+endian float32 rows. The header starts with MAGIC and the length of the
+JSON metadata that follows it, padded with zeros. Files are written to a
+temporary file and renamed into place, so a cache file either is complete
+or does not exist, and loaded as copy-on-write memory maps.
+
+Older versions cached the grid as a float64 parsed_data.npy next to a
+metadata.json, load_dir and read_dir_metadata read those as well.
+
+Sample calls:
+write('cache/parsed_data/<region>/region.rgn', grid, metadata)
+
+grid, metadata = load('cache/parsed_data/<region>/region.rgn')
+
+"""
+import os
+import json
+import struct
+
+import numpy as np
+
+
+CACHE_FILENAME = "region.rgn"
+LEGACY_GRID_FILENAME = "parsed_data.npy"
+LEGACY_METADATA_FILENAME = "metadata.json"
+
+MAGIC = "SRTMRGN1"
+HEADER_SIZE = 4096
+DTYPE = np.dtype('<f4')
+
+# samples without data, as the SRTM manager returns for missing tiles
+NODATA = 0
+
+# rows written at a time
+WRITE_ROWS = 1024
+
+
+class RegionCacheError(Exception):
+    pass
+
+
+def write(filepath, grid, metadata):
+    """Write grid and the metadata dict to filepath atomically."""
+    metadata = dict(metadata)
+    metadata.update({"grid_dtype": DTYPE.str, "grid_shape": list(grid.shape),
+                     "nodata": NODATA})
+    data = json.dumps(metadata)
+    header = MAGIC + struct.pack('<I', len(data)) + data
+    if len(header) > HEADER_SIZE:
+        raise RegionCacheError("metadata of %d bytes does not fit the "
+                               "header" % len(data))
+
+    tmp_filepath = '%s.%d.tmp' % (filepath, os.getpid())
+    f = open(tmp_filepath, 'wb')
+    try:
+        f.write(header + '\0' * (HEADER_SIZE - len(header)))
+        # a few rows at a time, so memory mapped grids are not loaded at once
+        for start in range(0, grid.shape[0], WRITE_ROWS):
+            np.asarray(grid[start:start + WRITE_ROWS],
+                       dtype=DTYPE).tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    except:
+        f.close()
+        os.remove(tmp_filepath)
+        raise
+    f.close()
+    os.rename(tmp_filepath, filepath)
+
+
+def read_metadata(filepath):
+    """Return the metadata dict from the header of filepath."""
+    f = open(filepath, 'rb')
+    try:
+        header = f.read(HEADER_SIZE)
+    finally:
+        f.close()
+    if len(header) < HEADER_SIZE or not header.startswith(MAGIC):
+        raise RegionCacheError("%s is not a region cache file" % filepath)
+    length = struct.unpack('<I', header[len(MAGIC):len(MAGIC) + 4])[0]
+    start = len(MAGIC) + 4
+    try:
+        return json.loads(header[start:start + length])
+    except ValueError:
+        raise RegionCacheError("%s has a corrupt header" % filepath)
+
+
+def load(filepath, mode='c'):
+    """Return the grid of filepath as a memory map, copy-on-write by
+    default, and its metadata."""
+    metadata = read_metadata(filepath)
+    dtype = np.dtype(str(metadata["grid_dtype"]))
+    shape = tuple(metadata["grid_shape"])
+    expected_size = HEADER_SIZE + int(np.prod(shape)) * dtype.itemsize
+    if os.path.getsize(filepath) != expected_size:
+        raise RegionCacheError("%s is truncated" % filepath)
+    grid = np.memmap(filepath, dtype=dtype, mode=mode, offset=HEADER_SIZE,
+                     shape=shape)
+    return grid, metadata
+
+
+def exists(cache_dir):
+    """Whether cache_dir holds a cached grid in either format."""
+    return os.path.exists(os.path.join(cache_dir, CACHE_FILENAME)) or \
+        os.path.exists(os.path.join(cache_dir, LEGACY_GRID_FILENAME))
+
+
+def _read_legacy_metadata(cache_dir):
+    f = open(os.path.join(cache_dir, LEGACY_METADATA_FILENAME), 'r')
+    try:
+        return json.loads(f.read())
+    finally:
+        f.close()
+
+
+def read_dir_metadata(cache_dir):
+    """Return the metadata of the grid cached in cache_dir, or None if it
+    has none or it can't be read."""
+    try:
+        return read_metadata(os.path.join(cache_dir, CACHE_FILENAME))
+    except (IOError, RegionCacheError):
+        pass
+    try:
+        return _read_legacy_metadata(cache_dir)
+    except (IOError, ValueError):
+        return None
+
+
+def load_dir(cache_dir, mode='c'):
+    """Return the grid and metadata cached in cache_dir in either format.
+    Raises IOError if there is none."""
+    filepath = os.path.join(cache_dir, CACHE_FILENAME)
+    if os.path.exists(filepath):
+        return load(filepath, mode)
+    grid = np.load(os.path.join(cache_dir, LEGACY_GRID_FILENAME),
+                   mmap_mode=mode)
+    return grid, _read_legacy_metadata(cache_dir)
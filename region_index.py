@@ -0,0 +1,198 @@
+import os
+import json
+import math
+
+import region_cache
+
+
+INDEX_FILENAME = "index.json"
+
+# metadata keys kept in the index
+INDEX_KEYS = ["north_lat", "east_lng", "south_lat", "west_lng",
+              "lat_sample_points", "lng_sample_points",
+              "lat_interval", "lng_interval", "srtm_format", "patch_mode",
+              "overview_factor"]
+
+# values of the keys metadata written by older versions may lack
+INDEX_DEFAULTS = {"overview_factor": 1}
+
+# slack for float noise when comparing coordinates and intervals
+EPSILON = 1e-9
+
+
+class RegionCacheIndex:
+    """Spatial index of the region grids cached in cache/parsed_data.
+
+    Every cache dir is registered under each 1 degree cell its bounds
+    touch, using the bounds and sampling intervals from its metadata. The
+    index is kept in index.json next to the cache dirs and rebuilt from the
+    cached metadata if that is missing or unreadable.
+
+    Sample calls:
+    index = RegionCacheIndex('cache/parsed_data')
+
+    index.find_covering(37.7, -122.5, 37.8, -122.4, 0.0001, 0.0001, 1, 'auto')
+
+    """
+    def __init__(self, base_cache_dir):
+        self.base_cache_dir = base_cache_dir
+        self.index_filepath = os.path.join(base_cache_dir, INDEX_FILENAME)
+        self.entries = {}
+        self.cells = {}
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.index_filepath):
+            f = open(self.index_filepath, 'r')
+            try:
+                entries = json.loads(f.read())
+            except ValueError:
+                entries = None
+            f.close()
+            # entries of older indexes are missing keys, reread them
+            if entries is not None and not any(
+                    key not in entry for entry in entries.values()
+                    for key in INDEX_KEYS):
+                for name, metadata in entries.items():
+                    self._insert(name, metadata)
+                return
+        self.rebuild()
+
+    def rebuild(self):
+        """Recreate the index from the metadata of every cache dir."""
+        self.entries = {}
+        self.cells = {}
+        if not os.path.isdir(self.base_cache_dir):
+            return
+        for name in os.listdir(self.base_cache_dir):
+            dirpath = os.path.join(self.base_cache_dir, name)
+            if not os.path.isdir(dirpath):
+                continue
+            metadata = region_cache.read_dir_metadata(dirpath)
+            if metadata is not None:
+                self._insert(name, metadata)
+        self.save()
+
+    def save(self):
+        if not os.path.isdir(self.base_cache_dir):
+            os.makedirs(self.base_cache_dir)
+        tmp_filepath = '%s.%d.tmp' % (self.index_filepath, os.getpid())
+        f = open(tmp_filepath, 'w')
+        f.write(json.dumps(self.entries))
+        f.close()
+        os.rename(tmp_filepath, self.index_filepath)
+
+    def add(self, cache_dir, metadata):
+        """Register the region cached in cache_dir and save the index."""
+        self._insert(os.path.basename(cache_dir), metadata)
+        self.save()
+
+    def remove(self, name):
+        """Unregister the region cached in the dir name and save the index.
+        """
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            return
+        for cell in self._cells(entry):
+            self.cells.get(cell, set()).discard(name)
+        self.save()
+
+    def _insert(self, name, metadata):
+        metadata = dict(INDEX_DEFAULTS, **metadata)
+        if any(key not in metadata for key in INDEX_KEYS):
+            return  # written before the index existed
+        entry = dict((key, metadata[key]) for key in INDEX_KEYS)
+        self.entries[name] = entry
+        for cell in self._cells(entry):
+            self.cells.setdefault(cell, set()).add(name)
+
+    @staticmethod
+    def _cells(entry):
+        south = int(math.floor(entry["south_lat"]))
+        north = int(math.floor(entry["north_lat"]))
+        west = int(math.floor(entry["west_lng"]))
+        east = int(math.floor(entry["east_lng"]))
+        return [(lat, lng) for lat in range(south, north + 1)
+                for lng in range(west, east + 1)]
+
+    @staticmethod
+    def sampled_bounds(entry):
+        """Return the south, west, north and east of the samples of the grid
+        of entry. The first row and column of a cached grid are never
+        sampled."""
+        return (entry["south_lat"] + entry["lat_interval"],
+                entry["west_lng"] + entry["lng_interval"],
+                entry["south_lat"] +
+                (entry["lat_sample_points"] - 1) * entry["lat_interval"],
+                entry["west_lng"] +
+                (entry["lng_sample_points"] - 1) * entry["lng_interval"])
+
+    def find_covering(self, south_lat, west_lng, north_lat, east_lng,
+                      lat_interval, lng_interval, srtm_format, patch_mode,
+                      overview_factor=1):
+        """Return (name, entry) for the cached grid that has samples over
+        the whole of the given bounds at the same or a finer interval,
+        sampled from the same or finer overviews, or None. If there are
+        several, the coarsest one is picked.
+        """
+        cell = (int(math.floor(south_lat)), int(math.floor(west_lng)))
+        best = None
+        for name in self.cells.get(cell, ()):
+            entry = self.entries[name]
+            if entry["srtm_format"] != srtm_format or \
+                    entry["patch_mode"] != patch_mode or \
+                    entry["overview_factor"] > overview_factor:
+                continue
+            if entry["lat_interval"] > lat_interval + EPSILON or \
+                    entry["lng_interval"] > lng_interval + EPSILON:
+                continue
+
+            sampled_south, sampled_west, sampled_north, sampled_east = \
+                self.sampled_bounds(entry)
+            if south_lat < sampled_south - EPSILON or \
+                    north_lat > sampled_north + EPSILON or \
+                    west_lng < sampled_west - EPSILON or \
+                    east_lng > sampled_east + EPSILON:
+                continue
+
+            if not region_cache.exists(os.path.join(self.base_cache_dir,
+                                                    name)):
+                continue
+            if best is None or entry["lat_interval"] > best[1]["lat_interval"]:
+                best = (name, entry)
+        return best
+
+    def find_overlapping(self, south_lat, west_lng, north_lat, east_lng,
+                         lat_interval, lng_interval, srtm_format, patch_mode,
+                         overview_factor=1, tolerance=1e-6):
+        """Return [(name, entry)] of the cached grids sampled at the same
+        intervals, within a relative tolerance, and overview factor that
+        have samples inside the given bounds."""
+        names = set()
+        bounds = {"south_lat": south_lat, "west_lng": west_lng,
+                  "north_lat": north_lat, "east_lng": east_lng}
+        for cell in self._cells(bounds):
+            names.update(self.cells.get(cell, ()))
+
+        found = []
+        for name in sorted(names):
+            entry = self.entries[name]
+            if entry["srtm_format"] != srtm_format or \
+                    entry["patch_mode"] != patch_mode or \
+                    entry["overview_factor"] != overview_factor:
+                continue
+            if abs(entry["lat_interval"] - lat_interval) > \
+                    tolerance * lat_interval or \
+                    abs(entry["lng_interval"] - lng_interval) > \
+                    tolerance * lng_interval:
+                continue
+            sampled_south, sampled_west, sampled_north, sampled_east = \
+                self.sampled_bounds(entry)
+            if sampled_south > north_lat or sampled_north < south_lat or \
+                    sampled_west > east_lng or sampled_east < west_lng:
+                continue
+            if not region_cache.exists(os.path.join(self.base_cache_dir,
+                                                    name)):
+                continue
+            found.append((name, entry))
+        return found
@@ -0,0 +1,188 @@
+"""Colour-map region grids straight into PNG files, without matplotlib
+figures.
+
+Sample calls:
+save_png(region.outfile, 'images/map.png', colormap='jet', size=(1440, 900))
+
+save_png_stream(region.outfile, 'images/huge.png', colormap='gray')
+
+"""
+import os
+import zlib
+import struct
+
+import numpy as np
+
+import instrument
+
+
+# rows colour-mapped at a time
+STREAM_ROWS = 256
+
+# entries of a colormap lookup table, as many as matplotlib uses
+LUT_SIZE = 256
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+
+def colormap_lut(colormap, size=LUT_SIZE):
+    """Return the RGB colours of a matplotlib colormap (or its name) as a
+    size x 3 uint8 lookup table."""
+    import matplotlib.cm as cm
+
+    colormap = cm.get_cmap(colormap)
+    return colormap(np.linspace(0, 1, size), bytes=True)[:, :3]
+
+
+def value_range(grid, rows=STREAM_ROWS):
+    """Return the min and max of grid ignoring NaN, read rows at a time
+    so memory mapped grids are never loaded at once."""
+    return _scan(grid, rows)[:2]
+
+
+def _scan(grid, rows=STREAM_ROWS):
+    """Return the min and max of grid ignoring NaN and whether it has NaN
+    voids."""
+    vmin = np.inf
+    vmax = -np.inf
+    voids = False
+    for start in range(0, grid.shape[0], rows):
+        window = np.asarray(grid[start:start + rows])
+        nan = np.isnan(window)
+        voids = voids or bool(nan.any())
+        finite = window[np.isfinite(window)]
+        if finite.size:
+            vmin = min(vmin, finite.min())
+            vmax = max(vmax, finite.max())
+    if vmin > vmax:
+        return 0.0, 0.0, voids
+    return float(vmin), float(vmax), voids
+
+
+def apply_lut(values, lut, vmin, vmax, alpha=False):
+    """Colour values with lut, spreading vmin to vmax over the table the
+    way imshow normalizes. Returns an RGB uint8 array, or RGBA with alpha
+    that is transparent where values are NaN, like the colormap's bad
+    colour."""
+    size = lut.shape[0]
+    values = np.asarray(values, dtype=np.float64)
+    if vmax > vmin:
+        scaled = (values - vmin) * (size / (vmax - vmin))
+    else:
+        scaled = np.zeros(values.shape)
+    void = np.isnan(scaled)
+    scaled[void] = 0
+    indices = np.clip(scaled, 0, size - 1).astype(np.intp)
+    rgb = lut[indices]
+    if not alpha:
+        return rgb
+    rgba = np.empty(values.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = rgb
+    rgba[..., 3] = np.where(void, 0, 255)
+    return rgba
+
+
+def shade_rgb(rgb, shade, strength=0.5):
+    """Darken rgb (or the colours of rgba) by shade, from 0 (dark) to 1
+    (lit), mixed in at strength from 0 (not at all) to 1."""
+    factor = 1 - strength + strength * np.asarray(shade, dtype=np.float64)
+    shaded = rgb.copy()
+    shaded[..., :3] = rgb[..., :3] * factor[..., np.newaxis]
+    return shaded
+
+
+def colorize(grid, colormap="gray", shade=None, shade_strength=0.5):
+    """Return grid coloured through colormap as an RGB uint8 array, RGBA
+    with transparent voids if it has NaN, darkened by shade if given."""
+    vmin, vmax, voids = _scan(grid)
+    rgb = apply_lut(grid, colormap_lut(colormap), vmin, vmax, voids)
+    if shade is not None:
+        rgb = shade_rgb(rgb, shade, shade_strength)
+    return rgb
+
+
+def _resize(grid, size):
+    from PIL import Image
+
+    image = Image.fromarray(np.asarray(grid, dtype=np.float32), 'F')
+    return np.asarray(image.resize(tuple(int(s) for s in size),
+                                   Image.BILINEAR))
+
+
+def save_png(grid, filepath, colormap="gray", size=None, shade=None,
+             shade_strength=0.5):
+    """Write grid as an RGB png through colormap, darkened by shade if
+    given, with an alpha channel transparent at NaN voids if it has any.
+    With size (width, height) in pixels, the grid is resampled
+    bilinearly to exactly that size first, otherwise every sample becomes
+    one pixel."""
+    from PIL import Image
+
+    with instrument.span("encode", filepath=filepath, renderer="pillow"):
+        vmin, vmax, voids = _scan(grid)
+        values = grid
+        if size is not None and \
+                tuple(size) != (values.shape[1], values.shape[0]):
+            values = _resize(values, size)
+            if shade is not None:
+                shade = _resize(shade, size)
+        rgb = apply_lut(values, colormap_lut(colormap), vmin, vmax, voids)
+        if shade is not None:
+            rgb = shade_rgb(rgb, shade, shade_strength)
+        Image.fromarray(rgb, 'RGBA' if voids else 'RGB').save(filepath,
+                                                               'PNG')
+
+
+def _png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + \
+        struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def save_png_stream(grid, filepath, colormap="gray", rows=STREAM_ROWS,
+                    compression=6, shade=None, shade_strength=0.5):
+    """Write grid as an RGB png through colormap, darkened by shade if
+    given, one sample per pixel, with an alpha channel transparent at NaN
+    voids if it has any. Rows are coloured and compressed a few at a time,
+    so memory use only depends on the width and this works for memory
+    mapped grids of any height."""
+    height, width = grid.shape
+    lut = colormap_lut(colormap)
+    vmin, vmax, voids = _scan(grid, rows)
+    channels = 4 if voids else 3
+
+    with instrument.span("encode", filepath=filepath, renderer="stream"):
+        tmp_filepath = '%s.%d.tmp' % (filepath, os.getpid())
+        f = open(tmp_filepath, 'wb')
+        try:
+            f.write(PNG_SIGNATURE)
+            # 8 bit RGB or RGBA, no interlacing
+            f.write(_png_chunk('IHDR', struct.pack(
+                '>IIBBBBB', width, height, 8, 6 if voids else 2, 0, 0, 0)))
+
+            compressor = zlib.compressobj(compression)
+            previous = np.zeros(width * channels, dtype=np.uint8)
+            for start in range(0, height, rows):
+                rgb = apply_lut(grid[start:start + rows], lut, vmin, vmax,
+                                voids)
+                if shade is not None:
+                    rgb = shade_rgb(rgb, shade[start:start + rows],
+                                    shade_strength)
+                rgb = rgb.reshape(rgb.shape[0], -1)
+
+                # the Up filter stores each row as its difference to the one
+                # above, which compresses terrain much better than raw rows
+                scanlines = np.empty((rgb.shape[0], rgb.shape[1] + 1),
+                                     dtype=np.uint8)
+                scanlines[:, 0] = 2
+                scanlines[0, 1:] = rgb[0] - previous
+                scanlines[1:, 1:] = rgb[1:] - rgb[:-1]
+                previous = rgb[-1]
+
+                data = compressor.compress(scanlines.tostring())
+                if data:
+                    f.write(_png_chunk('IDAT', data))
+            f.write(_png_chunk('IDAT', compressor.flush()))
+            f.write(_png_chunk('IEND', ''))
+        finally:
+            f.close()
+        os.rename(tmp_filepath, filepath)
@@ -0,0 +1,68 @@
+"""Slope, aspect and hillshade of elevation grids.
+
+Grids have north at row 0 and east at the last column. Spacings are in
+metres: dy between rows, dx between columns, which can be an array with one
+spacing per row because columns get closer together towards the poles.
+"""
+import numpy as np
+
+
+# light from the west round to the north, like most hand drawn relief
+DEFAULT_AZIMUTHS = (225, 270, 315, 360)
+DEFAULT_ALTITUDE = 45
+
+
+def gradient(grid, dx, dy):
+    """Return the east and north gradients of grid with Horn's 3x3 kernel.
+    The result is 2 rows and 2 columns smaller than grid, for the interior
+    pixels, and an array dx holds the spacing of each of its rows."""
+    grid = np.asarray(grid, dtype=np.float64)
+    dx = np.asarray(dx, dtype=np.float64)
+    if dx.ndim:
+        dx = dx[:, np.newaxis]
+
+    nw, n, ne = grid[:-2, :-2], grid[:-2, 1:-1], grid[:-2, 2:]
+    w, e = grid[1:-1, :-2], grid[1:-1, 2:]
+    sw, s, se = grid[2:, :-2], grid[2:, 1:-1], grid[2:, 2:]
+
+    dzdx = ((ne + 2 * e + se) - (nw + 2 * w + sw)) / (8 * dx)
+    dzdy = ((nw + 2 * n + ne) - (sw + 2 * s + se)) / (8 * dy)
+    return dzdx, dzdy
+
+
+def slope(dzdx, dzdy, z_factor=1.0):
+    """Slope in degrees from the gradients."""
+    return np.degrees(np.arctan(z_factor * np.hypot(dzdx, dzdy)))
+
+
+def aspect(dzdx, dzdy):
+    """Direction the slope faces in degrees clockwise from north."""
+    return np.degrees(np.arctan2(-dzdx, -dzdy)) % 360
+
+
+def hillshade(dzdx, dzdy, azimuths=DEFAULT_AZIMUTHS,
+              altitude=DEFAULT_ALTITUDE, z_factor=1.0):
+    """Return the mean illumination from 0 to 1 of the surface lit from
+    each of azimuths (degrees clockwise from north) at altitude degrees
+    above the horizon."""
+    dzdx = z_factor * np.asarray(dzdx)
+    dzdy = z_factor * np.asarray(dzdy)
+    norm = np.sqrt(1 + dzdx ** 2 + dzdy ** 2)
+    altitude = np.radians(altitude)
+
+    shade = np.zeros(dzdx.shape)
+    for azimuth in azimuths:
+        azimuth = np.radians(azimuth)
+        # dot product of the surface normal (-dzdx, -dzdy, 1) and the light
+        light = (-dzdx * np.sin(azimuth) * np.cos(altitude) -
+                 dzdy * np.cos(azimuth) * np.cos(altitude) +
+                 np.sin(altitude)) / norm
+        shade += np.maximum(light, 0)
+    return shade / len(azimuths)
+
+
+def pad_edges(grid, top, bottom):
+    """Pad grid by a repeated edge pixel on the left and right, and on the
+    top and bottom where top or bottom are True, so shading keeps the shape
+    of the grid."""
+    return np.pad(grid, ((int(top), int(bottom)), (1, 1)), mode='edge')
@@ -8,16 +8,33 @@
 """Load and process SRTM data."""
 
 #import xml.dom.minidom
-from HTMLParser import HTMLParser
-import ftplib
-import httplib
 import re
-import pickle
 import os.path
 import os
 import zipfile
-import array
 import math
+import threading
+import collections
+import multiprocessing
+
+import numpy as np
+
+import instrument
+import tile_source
+import catalog
+import cache_manager
+# moved to tile_source, kept importable from here
+from tile_source import parseHTMLDirectoryListing
+
+
+# SRTM marks pixels without data with this value
+SRTM_VOID = -32768
+
+# about 20 SRTM1 tiles
+DEFAULT_TILE_CACHE_BYTES = 512 * 1024 * 1024
+
+# coarsest overview level, as a downsampling factor
+MAX_OVERVIEW_FACTOR = 16
 
 
 class NoSuchTileError(Exception):
@@ -53,6 +70,199 @@ class InvalidTileError(Exception):
         return "SRTM tile for %d, %d is invalid!" % (self.lat, self.lon)
 
 
+def _fill_pass(grid, void, rows=slice(None), cols=slice(None),
+               fillable=True):
+    """Replace every void in grid[rows, cols] (and in fillable, a mask of
+    the box, if given) that has a valid pixel in its 8-neighbourhood with
+    the mean of those neighbours, the same estimate SRTMTile.interpolate
+    makes. The neighbours outside the box are read from grid, edge pixels
+    of grid see its border repeated. Estimates outside the interpolate
+    sanity range are left void.
+    Returns the number of pixels filled.
+    """
+    rows = slice(*rows.indices(grid.shape[0])[:2])
+    cols = slice(*cols.indices(grid.shape[1])[:2])
+    # the box and a pixel around it, repeating the border where the box
+    # reaches the edge of grid
+    top = max(rows.start - 1, 0)
+    bottom = min(rows.stop + 1, grid.shape[0])
+    left = max(cols.start - 1, 0)
+    right = min(cols.stop + 1, grid.shape[1])
+    padding = ((1 - (rows.start - top), 1 - (bottom - rows.stop)),
+               (1 - (cols.start - left), 1 - (right - cols.stop)))
+    window_void = void[top:bottom, left:right]
+    values = np.pad(np.where(window_void, 0, grid[top:bottom, left:right])
+                    .astype(np.float64), padding, 'edge')
+    valid = np.pad(~window_void, padding, 'edge').astype(np.float64)
+    height = rows.stop - rows.start
+    width = cols.stop - cols.start
+
+    total = np.zeros((height, width))
+    count = np.zeros((height, width))
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            if dy == 1 and dx == 1:
+                continue
+            total += values[dy:dy + height, dx:dx + width]
+            count += valid[dy:dy + height, dx:dx + width]
+
+    box_void = void[rows, cols]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average = total / count
+        # the same limits interpolate drops implausible averages at
+        fill = box_void & fillable & (count > 0) & (average <= 5000) & \
+            (average >= -1)
+    grid[rows, cols][fill] = average[fill].astype(grid.dtype)
+    box_void[fill] = False
+    return int(fill.sum())
+
+
+def fill_voids(grid):
+    """Fill SRTM voids in a 2D grid in place.
+
+    Voids are filled from their edges inward, one ring of pixels per pass,
+    so void regions of any size get filled. The first pass runs over the
+    whole grid, which takes care of the many single pixel voids. After
+    that each remaining void region is worked on inside its own bounding
+    box, which shrinks as it fills.
+
+    Returns the number of pixels left void.
+    """
+    from scipy import ndimage
+
+    void = grid == SRTM_VOID
+    if not void.any():
+        return 0
+    _fill_pass(grid, void)
+
+    labels, _ = ndimage.label(void, structure=np.ones((3, 3)))
+    for label, region in enumerate(ndimage.find_objects(labels), 1):
+        while True:
+            # only this region, other regions in the box fill on their own
+            rows, cols = region
+            box_void = void[rows, cols] & (labels[rows, cols] == label)
+            if not _fill_pass(grid, void, rows, cols, box_void):
+                break
+            box_void &= void[rows, cols]
+            if not box_void.any():
+                break
+            region = ndimage.find_objects(box_void.astype(np.int8))[0]
+            region = (slice(region[0].start + rows.start,
+                            region[0].stop + rows.start),
+                      slice(region[1].start + cols.start,
+                            region[1].stop + cols.start))
+    return int(void.sum())
+
+
+def _downsample_axis(a, axis):
+    """Return the 1-2-1 weighted sums of a around every second pixel along
+    axis. The first and last pixels are only weighted by themselves, so the
+    edge a tile shares with its neighbour comes out the same in both."""
+    a = np.swapaxes(a, 0, axis).astype(np.float64)
+    summed = 2.0 * a[::2]
+    summed[1:-1] += a[1:-2:2] + a[3::2]
+    return np.swapaxes(summed, 0, axis)
+
+
+def downsample(grid):
+    """Halve the resolution of a (2n+1)x(2n+1) tile grid to (n+1)x(n+1).
+
+    Every output pixel is the area weighted average of the 3x3 input pixels
+    around it (1-2-1 weights in each direction), skipping voids. Pixels
+    only surrounded by voids stay void. Edge pixels still line up with the
+    tile edges.
+    """
+    valid = grid != SRTM_VOID
+    values = np.where(valid, grid, 0)
+    total = _downsample_axis(_downsample_axis(values, 0), 1)
+    weight = _downsample_axis(_downsample_axis(valid, 0), 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average = np.round(total / weight)
+    return np.where(weight > 0, average, SRTM_VOID).astype(np.int16)
+
+
+class TileCache:
+    """Least recently used cache of tiles keyed by integer (lat, lon).
+
+    Tiles are evicted oldest first once the cached grids take up more than
+    max_bytes. Pinned tiles are never evicted; pins are counted, so every
+    pin needs a matching unpin. The cache can be shared between threads.
+    """
+    def __init__(self, max_bytes=DEFAULT_TILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.tiles = collections.OrderedDict()
+        self.pins = collections.defaultdict(int)
+        self.nbytes = 0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def tile_nbytes(tile):
+        grid = getattr(tile, 'grid', None)
+        if grid is None:
+            return 0
+        return grid.nbytes
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def get(self, key):
+        """Return the tile for key and mark it as recently used, or None
+        if it is not cached."""
+        with self._lock:
+            tile = self.tiles.pop(key, None)
+            if tile is None:
+                self.misses += 1
+                return None
+            self.tiles[key] = tile
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile):
+        with self._lock:
+            if key in self.tiles:
+                self.nbytes -= self.tile_nbytes(self.tiles.pop(key))
+            self.tiles[key] = tile
+            self.nbytes += self.tile_nbytes(tile)
+            self._evict()
+
+    def _evict(self):
+        for key in list(self.tiles):
+            if self.nbytes <= self.max_bytes:
+                break
+            if self.pins.get(key):
+                continue
+            self.nbytes -= self.tile_nbytes(self.tiles.pop(key))
+            self.evictions += 1
+
+    def pin(self, keys):
+        with self._lock:
+            for key in keys:
+                self.pins[key] += 1
+
+    def unpin(self, keys):
+        with self._lock:
+            for key in keys:
+                self.pins[key] -= 1
+                if self.pins[key] <= 0:
+                    del self.pins[key]
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {"tiles": len(self.tiles), "bytes": self.nbytes,
+                    "max_bytes": self.max_bytes, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions,
+                    "pinned": len(self.pins)}
+
+
 class SRTMManager:
     """Manage SRTM Tiles. Handles local caching and patching nulls.
 
@@ -62,34 +272,57 @@ class SRTMManager:
     srtm_manager.get_altitude(32.2123, -121.3452)
 
     """
+    # pixels per degree of each SRTM format
+    SAMPLES_PER_DEGREE = {1: 3600, 3: 1200}
+
     def __init__(self, server="dds.cr.usgs.gov", cachedir="cache/srtm",
-                 protocol="http", srtm_format=1, patch_mode="auto"):
-        self.tile_cache = {}
+                 protocol="http", srtm_format=1, patch_mode="auto",
+                 tile_cache_bytes=DEFAULT_TILE_CACHE_BYTES, offline=False,
+                 source=None):
+        self.tile_cache = TileCache(max_bytes=tile_cache_bytes)
+
+        # directory on remote server to check for SRTM files
+        self.directory = tile_source.default_directory(srtm_format)
 
-        self.tile_cache['fake'] = 1
+        # where missing SRTM files are downloaded from, see tile_source
+        if source is None:
+            if protocol == "ftp":
+                source = tile_source.FTPTileSource(server, self.directory)
+            else:
+                source = tile_source.HTTPTileSource(server, self.directory)
+        self.source = source
+
+        # enough to create an equivalent manager in another process
+        self.settings = {"server": server, "cachedir": cachedir,
+                         "protocol": protocol, "srtm_format": srtm_format,
+                         "patch_mode": patch_mode, "offline": offline,
+                         "source": source}
 
         self.protocol = protocol
         self.server = server
+        self.srtm_format = srtm_format
 
         self.patch_mode = patch_mode
 
-        # directory on remote server to check for SRTM files
-        self.directory = "/srtm/version2_1/SRTM%s/" % srtm_format
+        # only use the files in cachedir, never connect to the server
+        self.offline = offline
 
         # local caching directory
         self.cachedir = cachedir + str(srtm_format)
         if not os.path.exists(self.cachedir):
             os.mkdir(self.cachedir)
 
-        self.filelist = {}
         self.filename_regex = re.compile(
             r"([NS])(\d{2})([EW])(\d{3})\.hgt\.zip")
+        # the file list pickled by older versions, migrated to the catalog
         self.filelist_file = os.path.join(self.cachedir, "filelist_python")
+        self.catalog = catalog.open_catalog(
+            os.path.join(self.cachedir, "catalog.sqlite"))
+        # hits of the cached files, for cache_manager
+        self.access_log = cache_manager.AccessLog(
+            os.path.join(self.cachedir, cache_manager.ACCESS_FILENAME))
         self.loadFileList()
 
-        self.ftpfile = None
-        self.ftp_bytes_transfered = 0
-
     def filename_coords(self, lat, lon):
         lat_name = 'N'
         lon_name = 'W'
@@ -112,94 +345,142 @@ class SRTMManager:
         #     print alt
         return alt
 
+    def overview_factor(self, spacing):
+        """Return the overview factor to sample at when samples are spacing
+        degrees apart: the coarsest level that is still at least as fine as
+        the samples."""
+        pixels = spacing * self.SAMPLES_PER_DEGREE[self.srtm_format]
+        factor = 1
+        while factor * 2 <= min(pixels, MAX_OVERVIEW_FACTOR):
+            factor *= 2
+        return factor
+
+    def get_altitude_grid(self, lats, lons, factor=1):
+        """Return altitudes for every combination of lats (rows) and lons
+        (columns) as a 2D float array. Samples are grouped by tile and each
+        tile is interpolated in one vectorized pass. Voids are NaN.
+        factor picks an overview level of the tiles, see getTile.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        alts = np.empty((lats.size, lons.size))
+
+        tile_lats = np.floor(lats)
+        tile_lons = np.floor(lons)
+
+        for tile_lat in np.unique(tile_lats):
+            rows = np.flatnonzero(tile_lats == tile_lat)
+            for tile_lon in np.unique(tile_lons):
+                cols = np.flatnonzero(tile_lons == tile_lon)
+                tile = self.getTile(tile_lat, tile_lon, factor)
+                lon_grid, lat_grid = np.meshgrid(lons[cols], lats[rows])
+                alts[np.ix_(rows, cols)] = tile.getAltitudesFromLatLons(
+                    lat_grid, lon_grid)
+        return alts
+
+    def get_altitudes(self, lats, lons, nodata=SRTM_VOID, factor=1):
+        """Return altitudes for arrays of lats and lons as a float array of
+        their broadcast shape. Points are bucketed by tile and each bucket is
+        interpolated in one vectorized pass. Voids and non-finite
+        coordinates come back as nodata.
+
+        Sample calls:
+        srtm_manager.get_altitudes([32.2123, 32.2124], [-121.3452, -121.3453])
+        """
+        lats, lons = np.broadcast_arrays(np.asarray(lats, dtype=np.float64),
+                                         np.asarray(lons, dtype=np.float64))
+        shape = lats.shape
+        lats = lats.ravel()
+        lons = lons.ravel()
+        alts = np.empty(lats.size)
+        alts.fill(np.nan)
+
+        points = np.flatnonzero(np.isfinite(lats) & np.isfinite(lons))
+        tile_lats = np.floor(lats[points])
+        tile_lons = np.floor(lons[points])
+
+        # sort the points by tile and walk the runs of equal tiles
+        order = np.lexsort((tile_lons, tile_lats))
+        points = points[order]
+        tile_lats = tile_lats[order]
+        tile_lons = tile_lons[order]
+        starts = np.flatnonzero(np.r_[True, (np.diff(tile_lats) != 0) |
+                                      (np.diff(tile_lons) != 0)])
+        stops = np.r_[starts[1:], points.size]
+
+        for start, stop in zip(starts, stops):
+            if start == stop:
+                continue  # no finite points at all
+            tile = self.getTile(tile_lats[start], tile_lons[start], factor)
+            bucket = points[start:stop]
+            alts[bucket] = tile.getAltitudesFromLatLons(lats[bucket],
+                                                        lons[bucket])
+
+        alts[np.isnan(alts)] = nodata
+        return alts.reshape(shape)
+
+    def get_altitude_grids(self, blocks, workers=1, factor=1):
+        """Yield get_altitude_grid(lats, lons, factor) for each (lats, lons)
+        in blocks, in order. With more than one worker the blocks are
+        sampled in a pool of processes, each with its own manager mapping
+        the same tile files, so the tiles should be prefetched first.
+        """
+        if workers <= 1:
+            for lats, lons in blocks:
+                yield self.get_altitude_grid(lats, lons, factor)
+            return
+
+        settings = self.settings
+        if self.patch_mode == "reprocess":
+            # the tiles were patched again when they were fetched here,
+            # the workers only load the patched files
+            settings = dict(settings, patch_mode="local")
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(settings,))
+        try:
+            for alts in pool.imap(_worker_altitude_grid,
+                                  [(lats, lons, factor)
+                                   for lats, lons in blocks]):
+                yield alts
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
     def loadFileList(self):
-        """Load a previously created file list or create a new one if none is
-            available."""
+        """Make sure the catalog knows the server's files and the cached
+        ones. A new catalog takes the file list of older versions if there
+        is one, or else downloads it."""
+        if self.catalog.get_meta("scanned") is None:
+            self.catalog.scan(self.cachedir)
+        if self.catalog.is_listed():
+            return
 
         if os.path.exists(self.filelist_file):
-            data = open(self.filelist_file, 'rb')
-
             try:
-                self.filelist = pickle.load(data)
-            except:
-                print "Unknown error loading cached file list. Recreating."
-                self.createFileList()
+                self.catalog.migrate_filelist(self.filelist_file)
+                return
+            except Exception:
+                print "Unknown error loading cached file list."
+        if self.offline:
+            print "No cached file list, only using cached tiles."
         else:
             print "No cached file list. Creating new one!"
             self.createFileList()
-            return
 
     def createFileList(self):
         """SRTM data is split into different directories, get a list of all of
-            them and create a dictionary for easy lookup."""
-        if self.protocol == "ftp":
-            ftp = ftplib.FTP(self.server)
-            try:
-                ftp.login()
-                ftp.cwd(self.directory)
-                regions = ftp.nlst()
-                for region in regions:
-                    print "Downloading file list for", region
-                    ftp.cwd(self.directory + "/" + region)
-                    files = ftp.nlst()
-                    for filename in files:
-                        self.filelist[self.parseFilename(filename)] = (
-                            region, filename)
-            finally:
-                ftp.close()
-            # Add meta info
-            self.filelist["server"] = self.server
-            self.filelist["directory"] = self.directory
-            with open(self.filelist_file, 'wb') as output:
-                pickle.dump(self.filelist, output)
-        else:
-            self.createFileListHTTP()
-
-    def createFileListHTTP(self):
-        """Create a list of the available SRTM files on the server using
-        HTTP file transfer protocol (rather than ftp).
-        30may2010  GJ ORIGINAL VERSION
-        """
-        print "createFileListHTTP"
-        conn = httplib.HTTPSConnection(self.server)
-        conn.request("GET", self.directory)
-        r1 = conn.getresponse()
-        if r1.status == 200:
-            print "status200 received ok"
-        else:
-            print "oh no = status=%d %s" % (r1.status, r1.reason)
-
-        data = r1.read()
-        parser = parseHTMLDirectoryListing()
-        parser.feed(data)
-        regions = parser.getDirListing()
-        print regions
-
-        for region in regions:
+            them and store it in the catalog for easy lookup."""
+        files = []
+        for region in self.source.list_regions():
             print "Downloading file list for", region
-            if 'jpg' in region:
-                continue
-            conn.request("GET", "%s/%s" % (self.directory, region))
-            r1 = conn.getresponse()
-            if r1.status == 200:
-                print "status200 received ok"
-            else:
-                print "oh no = status=%d %s" % (r1.status, r1.reason)
-            data = r1.read()
-            parser = parseHTMLDirectoryListing()
-            parser.feed(data)
-            files = parser.getDirListing()
-
-            for filename in files:
-                self.filelist[self.parseFilename(filename)] = (region,
-                                                               filename)
-
-            # print self.filelist
-        # Add meta info
-        self.filelist["server"] = self.server
-        self.filelist["directory"] = self.directory
-        with open(self.filelist_file, 'wb') as output:
-            pickle.dump(self.filelist, output)
+            for filename in self.source.list_files(region):
+                key = self.parseFilename(filename)
+                if key is not None:
+                    files.append(key + (region, filename))
+        self.catalog.set_remote(files, self.server, self.directory)
 
     def parseFilename(self, filename):
         """Get lat/lon values from filename."""
@@ -216,26 +497,110 @@ class SRTMManager:
             lon = -lon
         return lat, lon
 
-    def getTile(self, lat, lon):
+    def getTile(self, lat, lon, factor=1):
         """Return a tile, first try the cache.
+        With a factor above 1, return that overview level of the tile, which
+        is built from the tile and saved next to it the first time.
         """
-        tile_lat = int(math.floor(lat))
-        tile_lon = int(math.floor(lon))
+        key = self.tile_key(lat, lon, factor)
+
+        with instrument.span("tile_lookup", key=key) as span:
+            tile = self.tile_cache.get(key)
+            if tile is not None:
+                span.add(cache="hit")
+                return tile
+            span.add(cache="miss")
+
+            if factor > 1:
+                tile = self.getTile(lat, lon).overview(factor)
+                if tile.filepath is not None:
+                    self._mark_overviews(key[:2], factor)
+            else:
+                print "cache miss, fetching %s, %s" % key
+                tile = self.fetchTile(*key)
+            self.tile_cache.put(key, tile)
 
-        lat_str = str(tile_lat)
-        lon_str = str(tile_lon)
+        return tile
 
-        if lat_str in self.tile_cache:
-            if str(lon_str) in self.tile_cache[lat_str]:
-                return self.tile_cache[lat_str][lon_str]
-        else:
-            self.tile_cache[lat_str] = {}
+    @staticmethod
+    def tile_key(lat, lon, factor=1):
+        """Return the (lat, lon) of the tile containing a point, or
+        (lat, lon, factor) for an overview level."""
+        key = int(math.floor(lat)), int(math.floor(lon))
+        if factor > 1:
+            key += (factor,)
+        return key
+
+    def _mark_overviews(self, key, factor):
+        bits = catalog.overview_bits(factor)
+        row = self.catalog.lookup(*key)
+        if row is None or row.overviews & bits != bits:
+            self.catalog.mark(key[0], key[1], overviews=bits)
+
+    def prefetch(self, keys, workers=4):
+        """Load the tiles for keys into the tile cache. Tiles that are not
+        cached yet are fetched, downloaded and patched concurrently in a
+        pool of worker processes, which leave the results in cachedir.
+        Overview keys (lat, lon, factor) are built here afterwards, from
+        their tiles.
+        """
+        overviews = [key for key in keys
+                     if len(key) > 2 and key not in self.tile_cache]
+        tiles = set(key for key in keys if len(key) == 2)
+        tiles.update(key[:2] for key in overviews)
+        self._prefetch_tiles([key for key in sorted(tiles)
+                              if key not in self.tile_cache], workers)
+        for key in overviews:
+            self.getTile(*key)
+
+    def _prefetch_tiles(self, missing, workers):
+        """Load the (lat, lon) tiles of missing, which are not cached."""
+        # download first, concurrently over the source's connections
+        downloads = set()
+        for key in missing:
+            download = self._tile_files(*key)[2]
+            if download is not None:
+                downloads.add(download)
+        if downloads and not self.offline:
+            self.source.fetch_many(sorted(downloads), self.cachedir, workers)
+            for region, filename in downloads:
+                self._mark_downloaded(filename)
+
+        if workers <= 1 or len(missing) <= 1:
+            for key in missing:
+                self.getTile(*key)
+            return
 
-        print "cache miss, fetching %s, %s" % (tile_lat, tile_lon)
-        tile = self.fetchTile(tile_lat, tile_lon)
-        self.tile_cache[lat_str][lon_str] = tile
+        print "prefetching %d tiles with %d workers" % (len(missing), workers)
+        pool = multiprocessing.Pool(min(workers, len(missing)))
+        try:
+            fetched = pool.map(_prefetch_tile,
+                               [(self.settings, key) for key in missing])
+        finally:
+            pool.close()
+            pool.join()
+
+        for key, filepath in fetched:
+            if filepath is None:
+                tile = FakeSRTMTile()
+            else:
+                tile = SRTMTile(filepath, *key)
+            self.tile_cache.put(key, tile)
 
-        return tile
+    def pin_tiles(self, keys):
+        """Keep the tiles for keys in the tile cache until unpin_tiles, and
+        their files in cachedir, which cache_manager won't evict."""
+        self.tile_cache.pin(keys)
+        cache_manager.hold(self.cachedir, self._hold_names(keys))
+
+    def unpin_tiles(self, keys):
+        self.tile_cache.unpin(keys)
+        cache_manager.release(self.cachedir, self._hold_names(keys))
+
+    @staticmethod
+    def _hold_names(keys):
+        return sorted(set(cache_manager.tile_hold_name(*key[:2])
+                          for key in keys))
 
     def makeFakeFile(self, size):
         pass
@@ -245,27 +610,113 @@ class SRTMManager:
         If it is a new download, this will also patch the nulls before
         returning the tile.
         """
+        lat, lon = int(lat), int(lon)
+        try:
+            return self._fetch_tile(lat, lon)
+        except (IOError, OSError):
+            # cached files were removed behind the catalog's back
+            if not self.catalog.scan(self.cachedir, (lat, lon)):
+                raise
+            return self._fetch_tile(lat, lon)
+
+    def _fetch_tile(self, lat, lon):
+        row = self.catalog.lookup(lat, lon)
+        cached_filepath, srtm_needs_patching, download = \
+            self._tile_files(lat, lon, row)
+        if cached_filepath is None:
+            print "FakeFile: %s, %s" % (lat, lon)
+            return FakeSRTMTile()
+        if download is not None:
+            if self.offline:
+                print "FakeFile (offline): %s, %s" % (lat, lon)
+                return FakeSRTMTile()
+            self.downloadTile(*download)
 
-        patched_filename = None
+        if srtm_needs_patching:
+            srtm_tile = SRTMTile(cached_filepath, lat, lon)
+            srtm_tile.fill_nulls()
+            cached_filepath = srtm_tile.save_patched_file(
+                cachedir=self.cachedir)
+            self.catalog.mark(lat, lon, catalog.RAW_GRID | catalog.PATCHED |
+                              catalog.PATCHED_GRID)
+            self._touch(lat, lon, "raw")
+            self._touch(lat, lon, "patched")
+            return SRTMTile(cached_filepath, lat, lon)
+
+        tile = SRTMTile(cached_filepath, lat, lon)
+        # loading the tile unzipped it if it was not yet
+        flag = catalog.parse_tile_file(os.path.basename(cached_filepath))[2]
+        grid_flag = catalog.GRID_FLAGS[flag]
+        if row is None or not row.state & grid_flag:
+            self.catalog.mark(lat, lon, grid_flag)
+        self._touch(lat, lon, cache_manager.TILE_CLASSES[flag])
+        return tile
+
+    def _touch(self, lat, lon, cls):
+        self.access_log.touch(cache_manager.tile_entry_name(lat, lon, cls))
+
+    def _tile_files(self, lat, lon, row=None):
+        """Return the file a tile is loaded from, whether it still has to
+        be patched and the (region, filename) to download it as first, or
+        None if it is cached. The file is None if the server has no such
+        tile. The catalog row of the tile is looked up unless given.
+        """
+        lat, lon = int(lat), int(lon)
+        if row is None:
+            row = self.catalog.lookup(lat, lon)
+        files = self._resolve_tile_files(lat, lon, row)
+        if files[0] is not None and not files[1] and files[2] is None:
+            return files
+        # before downloading or patching, look for files copied into the
+        # cache dir since it was scanned
+        if self._unlisted_files(lat, lon, row):
+            self.catalog.scan(self.cachedir, (lat, lon))
+            files = self._resolve_tile_files(
+                lat, lon, self.catalog.lookup(lat, lon))
+        return files
+
+    def _unlisted_files(self, lat, lon, row):
+        """Whether the cache dir has files of a tile that the patch mode
+        would load but the catalog row does not list."""
+        state = row.state if row is not None else 0
+        prefix = self.filename_coords(lat, lon)
+        if row is not None and row.filename is not None:
+            raw_filename = row.filename
+        else:
+            raw_filename = prefix + '.hgt.zip'
+        candidates = [(catalog.RAW, raw_filename)]
+        if self.patch_mode in ("auto", "local"):
+            candidates.append((catalog.PATCHED,
+                               self.patched_file_name(lat, lon) + '.zip'))
+        if self.patch_mode == "auto":
+            candidates.append((catalog.FILLED, prefix + '_fill.zip'))
+        for flag, filename in candidates:
+            if not state & flag and \
+                    os.path.exists(os.path.join(self.cachedir, filename)):
+                return True
+        return False
+
+    def _resolve_tile_files(self, lat, lon, row):
+        state = row.state if row is not None else 0
         srtm_needs_patching = False
 
         if self.patch_mode == "auto":
             # first check for a tile patched by SRTMFill
-            patched_filename = self.filename_coords(lat, lon) + '_fill.zip'
-            cached_filepath = os.path.join(self.cachedir, patched_filename)
-            if not os.path.exists(cached_filepath):
-                # then check for a locally-patched file
+            if state & catalog.FILLED:
+                patched_filename = self.filename_coords(lat, lon) + \
+                    '_fill.zip'
+            # then check for a locally-patched file
+            elif state & catalog.PATCHED:
                 patched_filename = self.patched_file_name(lat, lon) + '.zip'
-                cached_filepath = os.path.join(self.cachedir, patched_filename)
-                # lastly check for the unpatched file and download if need be
-                if not os.path.exists(cached_filepath):
-                    srtm_needs_patching = True
+            # lastly check for the unpatched file and download if need be
+            else:
+                srtm_needs_patching = True
 
         # check for a tile filled by the local algorithm
         if self.patch_mode == "local":
-            patched_filename = self.patched_file_name(lat, lon) + '.zip'
-            cached_filepath = os.path.join(self.cachedir, patched_filename)
-            if not os.path.exists(cached_filepath):
+            if state & catalog.PATCHED:
+                patched_filename = self.patched_file_name(lat, lon) + '.zip'
+            else:
                 srtm_needs_patching = True
 
         # reprocess srtm file
@@ -273,64 +724,30 @@ class SRTMManager:
             srtm_needs_patching = True
 
         # use the unpatched file
+        download = None
         if self.patch_mode == "none" or srtm_needs_patching:
-            try:
-                region, filename = self.filelist[(int(lat), int(lon))]
-            except KeyError:
-                print "FakeFile: %s, %s" % (int(lat), int(lon))
-                return FakeSRTMTile()
-            cached_filepath = os.path.join(self.cachedir, filename)
-            if not os.path.exists(cached_filepath):
-                self.downloadTile(region, filename)
-
-        if srtm_needs_patching:
-            srtm_tile = SRTMTile(cached_filepath, int(lat), int(lon))
-            srtm_tile.fill_nulls()
-            cached_filepath = srtm_tile.save_patched_file(
-                cachedir=self.cachedir)
+            if row is None or row.filename is None:
+                return None, False, None
+            cached_filepath = os.path.join(self.cachedir, row.filename)
+            if not state & catalog.RAW:
+                if row.region is None:
+                    return None, False, None
+                download = (row.region, row.filename)
+        else:
+            cached_filepath = os.path.join(self.cachedir, patched_filename)
 
-        return SRTMTile(cached_filepath, int(lat), int(lon))
+        return cached_filepath, srtm_needs_patching, download
 
     def downloadTile(self, region, filename):
-        """Download a tile from NASA's server and store it in the cache."""
-        if self.protocol == "ftp":
-            ftp = ftplib.FTP(self.server)
-            try:
-                ftp.login()
-                ftp.cwd(self.directory + "/" + region)
-                # WARNING: This is not thread safe
-                self.ftpfile = open(self.cachedir + "/" + filename, 'wb')
-                self.ftp_bytes_transfered = 0
-                print ""
-                try:
-                    ftp.retrbinary("RETR " + filename, self.ftpCallback)
-                finally:
-                    self.ftpfile.close()
-                    self.ftpfile = None
-            finally:
-                ftp.close()
-        else:
-            conn = httplib.HTTPSConnection(self.server)
-            conn.set_debuglevel(0)
-            filepath = "%s%s%s" % (self.directory, region, filename)
-            print "filepath=%s" % filepath
-            conn.request("GET", filepath)
-            r1 = conn.getresponse()
-            if r1.status == 200:
-                print "status200 received ok"
-                data = r1.read()
-                self.ftpfile = open(self.cachedir + "/" + filename, 'wb')
-                self.ftpfile.write(data)
-                self.ftpfile.close()
-                self.ftpfile = None
-            else:
-                print "oh no = status=%d %s" % (r1.status, r1.reason)
+        """Download a tile from the tile source and store it in the cache."""
+        self.source.fetch(region, filename,
+                          os.path.join(self.cachedir, filename))
+        self._mark_downloaded(filename)
 
-    def ftpCallback(self, data):
-        """Called by ftplib when some bytes have been received."""
-        self.ftpfile.write(data)
-        self.ftp_bytes_transfered += len(data)
-        print "\r%d bytes transfered" % self.ftp_bytes_transfered,
+    def _mark_downloaded(self, filename):
+        key = self.parseFilename(filename)
+        if key is not None:
+            self.catalog.mark(key[0], key[1], catalog.RAW)
 
 
 class SRTMTile:
@@ -342,22 +759,83 @@ class SRTMTile:
         only have to look at a single tile.
         """
     def __init__(self, f, lat, lon):
-        zipf = zipfile.ZipFile(f, 'r')
-        names = zipf.namelist()
-        if len(names) != 1:
-            raise InvalidTileError(lat, lon)
-        data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data) / 2))  # 2 bytes per sample
-        # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
-            raise InvalidTileError(lat, lon)
+        self.filepath = f
         self.lat = lat
         self.lon = lon
 
+        # Tiles are unzipped once into a native-endian .npy next to the zip
+        # and memory mapped from there, so opening a tile only maps the file
+        # and processes sharing a tile share the page cache.
+        grid_filepath = self.grid_filename(f)
+        if not os.path.exists(grid_filepath) or \
+                os.path.getmtime(grid_filepath) < os.path.getmtime(f):
+            self._convert(f, grid_filepath)
+        self.grid = np.load(grid_filepath, mmap_mode='r')
+
+        self.size = self.grid.shape[0]
+        # Currently only SRTM1/3 is supported
+        if self.size not in (1201, 3601) or \
+                self.grid.shape != (self.size, self.size):
+            raise InvalidTileError(lat, lon)
+
+    @property
+    def data(self):
+        """Flat view of the grid, indexed by calcOffset."""
+        return self.grid.reshape(-1)
+
+    def overview_filename(self, factor):
+        return self.grid_filename(self.filepath)[:-len('.npy')] + \
+            '.ov%d.npy' % factor
+
+    def overview(self, factor):
+        """Return this tile downsampled by factor (a power of two), from
+        its .ov<factor>.npy file, building that from the next finer level if
+        it is missing or older than the tile."""
+        if (self.size - 1) % factor:
+            raise ValueError("Can't downsample a %d pixel tile by %d" % (
+                self.size, factor))
+        overview_filepath = self.overview_filename(factor)
+        grid_filepath = self.grid_filename(self.filepath)
+        if not os.path.exists(overview_filepath) or \
+                os.path.getmtime(overview_filepath) < \
+                os.path.getmtime(grid_filepath):
+            finer = self if factor == 2 else self.overview(factor // 2)
+            self._save_grid(downsample(finer.grid), overview_filepath)
+        return OverviewTile(overview_filepath, self.lat, self.lon, factor)
+
+    @staticmethod
+    def grid_filename(f):
+        """Return the path of the uncompressed copy of the tile zip f."""
+        if f.endswith('.zip'):
+            f = f[:-len('.zip')]
+        return f + '.npy'
+
+    def _convert(self, f, grid_filepath):
+        """Unzip a big-endian .hgt.zip into a native-endian .npy."""
+        with instrument.span("unzip", filename=os.path.basename(f)) as span:
+            zipf = zipfile.ZipFile(f, 'r')
+            names = zipf.namelist()
+            if len(names) != 1:
+                raise InvalidTileError(self.lat, self.lon)
+            data = zipf.read(names[0])
+            zipf.close()
+            span.add(bytes=len(data))
+        size = int(math.sqrt(len(data) / 2))  # 2 bytes per sample
+        if len(data) != size * size * 2:
+            raise InvalidTileError(self.lat, self.lon)
+        grid = np.frombuffer(data, dtype='>i2').reshape(size, size)
+        self._save_grid(grid, grid_filepath)
+
+    @staticmethod
+    def _save_grid(grid, grid_filepath):
+        # write to a temporary file first so other processes never map a
+        # partially written tile
+        tmp_filepath = '%s.%d.tmp' % (grid_filepath, os.getpid())
+        tmp_file = open(tmp_filepath, 'wb')
+        np.save(tmp_file, grid.astype(np.int16))
+        tmp_file.close()
+        os.rename(tmp_filepath, grid_filepath)
+
     @staticmethod
     def _avg(value1, value2, weight):
         """
@@ -370,6 +848,13 @@ class SRTMTile:
             return value1
         return value2 * weight + value1 * (1 - weight)
 
+    @staticmethod
+    def _avgs(value1, value2, weight):
+        """Vectorized _avg, with NaN standing in for None."""
+        value = value2 * weight + value1 * (1 - weight)
+        value = np.where(np.isnan(value1), value2, value)
+        return np.where(np.isnan(value2), value1, value)
+
     def calcOffset(self, x, y):
         """Calculate offset into data array. Only uses to test correctness
             of the formula."""
@@ -399,11 +884,40 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print offset
-        value = self.data[offset]
-        if value == -32768:
+        value = int(self.data[offset])
+        if value == SRTM_VOID:
             return None  # -32768 is a special value for areas with no data
         return value
 
+    def _getPixelValues(self, x, y):
+        """Vectorized _getPixelValue. Returns a float array with NaN for
+            voids."""
+        offset = x + self.size * (self.size - y - 1)
+        values = self.data[offset]
+        values = values.astype(np.float64)
+        values[values == SRTM_VOID] = np.nan
+        return values
+
+    def _getPixelAverages(self, x, y):
+        """Vectorized _getPixelAverage over arrays of pixel coordinates."""
+        x_int = np.clip(x.astype(np.intp), 0, self.size - 1)
+        y_int = np.clip(y.astype(np.intp), 0, self.size - 1)
+
+        x_frac = x - x_int
+        y_frac = y - y_int
+
+        x_offset = np.where(x_int + 1 < self.size, x_int + 1, x_int)
+        y_offset = np.where(y_int + 1 < self.size, y_int + 1, y_int)
+
+        value00 = self._getPixelValues(x_int, y_int)
+        value10 = self._getPixelValues(x_offset, y_int)
+        value01 = self._getPixelValues(x_int, y_offset)
+        value11 = self._getPixelValues(x_offset, y_offset)
+
+        value1 = self._avgs(value00, value10, x_frac)
+        value2 = self._avgs(value01, value11, x_frac)
+        return self._avgs(value1, value2, y_frac)
+
     def _getPixelAverage(self, x, y):
         x_int = int(x)
         y_int = int(y)
@@ -449,7 +963,8 @@ class SRTMTile:
         # print "-----\nFromLatLon", lon, lat
         lat -= self.lat
         lon -= self.lon
-        if lat < 0.0 or lat >= 1.0 or lon < 0.0 or lon >= 1.0:
+        # the tile includes its north and east edges
+        if lat < 0.0 or lat > 1.0 or lon < 0.0 or lon > 1.0:
             raise WrongTileError(self.lat, self.lon,
                                  self.lat + lat, self.lon + lon)
         x = lon * (self.size - 1)
@@ -457,6 +972,24 @@ class SRTMTile:
 
         return self._getPixelAverage(x, y)
 
+    def getAltitudesFromLatLons(self, lats, lons):
+        """Vectorized getAltitudeFromLatLon. Takes arrays of lat/lon pairs
+            and returns a float array of the same shape, with NaN where the
+            scalar version would return None.
+        """
+        lats = np.asarray(lats, dtype=np.float64) - self.lat
+        lons = np.asarray(lons, dtype=np.float64) - self.lon
+        outside = (lats < 0.0) | (lats > 1.0) | (lons < 0.0) | (lons > 1.0)
+        if outside.any():
+            i = np.flatnonzero(outside)[0]
+            raise WrongTileError(self.lat, self.lon,
+                                 self.lat + lats.flat[i],
+                                 self.lon + lons.flat[i])
+        x = lons * (self.size - 1)
+        y = lats * (self.size - 1)
+
+        return self._getPixelAverages(x, y)
+
     def interpolate(self, x, y, dist=1):
         """Retun a pixel value as a weighted average of the surrounding pixels.
         This is brute force right now. Need to algorithm this shit.
@@ -545,19 +1078,13 @@ class SRTMTile:
         version
         '''
         print "filling nulls"
-        for x in range(self.size):
-            for y in range(self.size):
-                pixel_value = self._getPixelValue(x, y)
-                if pixel_value is None:
-                    if srtm3_tile is not None:
-                        pass
-                    # Same as calcOffset, inlined for performance reasons
-                    offset = x + self.size * (self.size - y - 1)
-
-                    interpolated_value = self.interpolate(x, y)
-
-                    if interpolated_value is not None:
-                        self.data[offset] = int(interpolated_value)
+        # the mapped grid is read-only, patch a private copy
+        self.grid = np.array(self.grid)
+        with instrument.span("fill_nulls", lat=self.lat, lon=self.lon) as span:
+            voids_left = fill_voids(self.grid)
+            span.add(voids_left=voids_left)
+        if voids_left:
+            print "%d voids could not be filled" % voids_left
         print "finished filling nulls"
 
     @property
@@ -581,11 +1108,9 @@ class SRTMTile:
 
         patched_filepath = os.path.join(cachedir, self.patched_filename)
 
-        patched_file = open(patched_filepath, 'w')
-        self.data.byteswap()
-        self.data.tofile(patched_file)
+        patched_file = open(patched_filepath, 'wb')
+        self.grid.astype('>i2').tofile(patched_file)
         patched_file.close()
-        self.data.byteswap()
 
         zipped_filepath = patched_filepath + ".zip"
         zipped_file = zipfile.ZipFile(zipped_filepath, 'w')
@@ -594,71 +1119,65 @@ class SRTMTile:
 
         os.remove(patched_filepath)
 
+        # we already have the grid in memory, no need to unzip it again
+        self._save_grid(self.grid, self.grid_filename(zipped_filepath))
+
         return zipped_filepath
 
 
+class OverviewTile(SRTMTile):
+    '''
+    A tile downsampled by factor, see SRTMTile.overview. It covers the same
+    area as the tile with (size - 1) / factor + 1 pixels per side.
+    '''
+    def __init__(self, f, lat, lon, factor):
+        self.filepath = f
+        self.lat = lat
+        self.lon = lon
+        self.factor = factor
+        self.grid = np.load(f, mmap_mode='r')
+        self.size = self.grid.shape[0]
+
+
 class FakeSRTMTile(SRTMTile):
     '''
     This is just a fake tile for data that's missing. It's sort of safe to
     assume it's just water data and can be rendered as 0
     '''
     def __init__(self):
-        pass
+        self.filepath = None
 
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudesFromLatLons(self, lats, lons):
+        return np.zeros(np.shape(lats))
 
-class parseHTMLDirectoryListing(HTMLParser):
+    def overview(self, factor):
+        return self
+
+
+# the SRTMManager of a get_altitude_grids worker process
+_worker_manager = None
+
+
+def _init_worker(settings):
+    global _worker_manager
+    _worker_manager = SRTMManager(**settings)
+
+
+def _worker_altitude_grid(args):
+    lats, lons, factor = args
+    return _worker_manager.get_altitude_grid(lats, lons, factor)
+
+
+def _prefetch_tile(args):
+    """Pool worker for SRTMManager.prefetch. Returns the tile key and the
+    path of the file the tile was loaded from."""
+    settings, key = args
+    tile = SRTMManager(**settings).fetchTile(*key)
+    return key, tile.filepath
 
-    def __init__(self):
-        #print "parseHTMLDirectoryListing.__init__"
-        HTMLParser.__init__(self)
-        self.title = "Undefined"
-        self.isDirListing = False
-        self.dirList = []
-        self.inTitle = False
-        self.inHyperLink = False
-        self.currAttrs = ""
-        self.currHref = ""
-
-    def handle_starttag(self, tag, attrs):
-        #print "Encountered the beginning of a %s tag" % tag
-        if tag == "title":
-            self.inTitle = True
-        if tag == "a":
-            self.inHyperLink = True
-            self.currAttrs = attrs
-            for attr in attrs:
-                if attr[0] == 'href':
-                    self.currHref = attr[1]
-
-    def handle_endtag(self, tag):
-        #print "Encountered the end of a %s tag" % tag
-        if tag == "title":
-            self.inTitle = False
-        if tag == "a":
-            # This is to avoid us adding the parent directory to the list.
-            if self.currHref != "":
-                self.dirList.append(self.currHref)
-            self.currAttrs = ""
-            self.currHref = ""
-            self.inHyperLink = False
-
-    def handle_data(self, data):
-        if self.inTitle:
-            self.title = data
-            print "title=%s" % data
-            if "Index of" in self.title:
-                #print "it is an index!!!!"
-                self.isDirListing = True
-        if self.inHyperLink:
-            # We do not include parent directory in listing.
-            if "Parent Directory" in data:
-                self.currHref = ""
-
-    def getDirListing(self):
-        return self.dirList
 
 #DEBUG ONLY
 if __name__ == '__main__':
@@ -0,0 +1,23 @@
+"""Synthetic SRTM tiles for the tests."""
+import os
+import zipfile
+
+import numpy as np
+
+
+def tile_name(lat, lon):
+    return '%s%d%s%d' % ('N' if lat >= 0 else 'S', abs(lat),
+                         'E' if lon > 0 else 'W', abs(lon))
+
+
+def write_tile(cachedir, lat, lon, size=1201):
+    """Write a smooth, void free tile to cachedir as <name>.hgt.zip."""
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    ys, xs = np.mgrid[0:size, 0:size].astype(np.float64) / (size - 1)
+    grid = 100 + 1000 * np.abs(np.sin((lat + 1 - ys) * 3) *
+                               np.cos((lon + xs) * 2))
+    name = tile_name(lat, lon)
+    zipf = zipfile.ZipFile(os.path.join(cachedir, name + '.hgt.zip'), 'w')
+    zipf.writestr(name + '.hgt', grid.astype('>i2').tostring())
+    zipf.close()
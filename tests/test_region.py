@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+
+from region import Region
+from srtm import SRTMManager
+from util import circle_footprint, line_pixels
+from helpers import write_tile
+
+
+class IncrementalPanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srtm_cachedir = os.path.join(self.tmpdir, 'srtm')
+        for lat in (37, 38):
+            write_tile(self.srtm_cachedir + '3', lat, -123)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def region(self, north_lat, east_lng, south_lat, west_lng, base, **kw):
+        # a manager per region, so every render loads its tiles afresh
+        srtm_manager = SRTMManager(cachedir=self.srtm_cachedir,
+                                   srtm_format=3, patch_mode='none',
+                                   offline=True)
+        region = Region(north_lat, east_lng, south_lat, west_lng,
+                        resolution=120, padding_pct=0, srtm_format=3,
+                        patch_mode='none', auto_parse=False,
+                        base_cache_dir=os.path.join(self.tmpdir, base),
+                        srtm_manager=srtm_manager, **kw)
+        region.overlay_map()
+        region.close()
+        return region
+
+    def test_pan_with_workers_and_overviews(self):
+        self.region(38.3, -122.3, 37.7, -122.9, 'parsed_data')
+        panned = self.region(38.35, -122.27, 37.75, -122.87, 'parsed_data',
+                             incremental=True, workers=2)
+        self.assertTrue(panned.overview_factor > 1)
+
+        full = self.region(panned.north_lat, panned.east_lng,
+                           panned.south_lat, panned.west_lng, 'reference',
+                           workers=2)
+        self.assertEqual(full.overview_factor, panned.overview_factor)
+        np.testing.assert_allclose(np.asarray(panned.outfile),
+                                   np.asarray(full.outfile), atol=1e-3)
+
+
+class StampLinesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def stamp_pixel_by_pixel(self, grid, rows, cols, lines, values,
+                             footprint):
+        # the loop overlay_gps drew tracks with before it was vectorized
+        nrows, ncols = grid.shape
+        radius = footprint.shape[0] // 2
+        for line in range(lines.max() + 1):
+            for row, col in zip(rows[lines == line], cols[lines == line]):
+                for dy, dx in zip(*np.nonzero(footprint)):
+                    grid[min(row + dy - radius, nrows - 1),
+                         min(col + dx - radius, ncols - 1)] = values[line]
+
+    def test_track_along_the_edges(self):
+        region = Region(37.8, -122.4, 37.7, -122.5, resolution=60,
+                        padding_pct=0, auto_parse=False,
+                        base_cache_dir=self.tmpdir)
+        nrows, ncols = region.lat_sample_points, region.lng_sample_points
+        # overlay_gps maps points just inside the bounds to rows 1 to nrows
+        # and columns 1 to ncols
+        track_rows = np.array([nrows, nrows, nrows - 5, 1, 1, nrows // 2])
+        track_cols = np.array([1, ncols // 2, ncols, ncols, 1, 1])
+        rows, cols, lines = line_pixels(track_rows[:-1], track_cols[:-1],
+                                        track_rows[1:], track_cols[1:])
+        values = np.arange(1, track_rows.size, dtype=np.float64) * 100
+        footprint = circle_footprint(2)
+
+        region.outfile = np.zeros((nrows, ncols))
+        region._stamp_lines(rows, cols, lines, values, footprint)
+        expected = np.zeros((nrows, ncols))
+        self.stamp_pixel_by_pixel(expected, rows, cols, lines, values,
+                                  footprint)
+        np.testing.assert_array_equal(region.outfile, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+import numpy as np
+from scipy import ndimage
+
+import srtm
+
+
+class FillVoidsTest(unittest.TestCase):
+    def test_same_as_filling_the_whole_grid(self):
+        random = np.random.RandomState(0)
+        for trial in range(50):
+            size = random.randint(8, 60)
+            grid = (random.rand(size, size) * 800 + 100).astype(np.int16)
+            voids = ndimage.binary_dilation(random.rand(size, size) < 0.02,
+                                            iterations=random.randint(1, 5))
+            grid[voids | (random.rand(size, size) < 0.05)] = srtm.SRTM_VOID
+
+            # a pass over the whole grid at a time
+            expected = grid.copy()
+            void = expected == srtm.SRTM_VOID
+            while srtm._fill_pass(expected, void):
+                pass
+            srtm.fill_voids(grid)
+            np.testing.assert_array_equal(grid, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+import unittest
+
+import numpy as np
+
+from util import bresenham_line, line_pixels
+
+
+class LinePixelsTest(unittest.TestCase):
+    def test_same_pixels_as_bresenham_line(self):
+        random = np.random.RandomState(0)
+        starts = random.randint(-30, 30, (2000, 2))
+        ends = random.randint(-30, 30, (2000, 2))
+        ends[:20] = starts[:20]  # single pixel lines
+        rows, cols, lines = line_pixels(starts[:, 0], starts[:, 1],
+                                        ends[:, 0], ends[:, 1])
+        for line, (start, end) in enumerate(zip(starts, ends)):
+            self.assertEqual(
+                zip(rows[lines == line], cols[lines == line]),
+                bresenham_line(tuple(start), tuple(end)))
+
+
+if __name__ == '__main__':
+    unittest.main()
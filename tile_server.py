@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""Serve z/x/y web map tiles rendered from the local SRTM cache."""
+import os
+import re
+import math
+import Queue
+import argparse
+import threading
+import contextlib
+import collections
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import numpy as np
+
+from srtm import SRTMManager
+
+
+TILE_SIZE = 256
+
+# the 8 tiles around a tile
+NEIGHBOURS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+              if dx or dy]
+
+
+def tile_lngs(x, z, size=TILE_SIZE):
+    """Longitudes of the pixel centres of the columns of tile x."""
+    n = 2 ** z
+    return (x + (np.arange(size) + 0.5) / size) / n * 360.0 - 180.0
+
+
+def tile_lats(y, z, size=TILE_SIZE):
+    """Latitudes of the pixel centres of the rows of tile y, from north to
+    south (web mercator)."""
+    n = 2 ** z
+    mercator_y = math.pi * (1 - 2 * (y + (np.arange(size) + 0.5) / size) / n)
+    return np.degrees(np.arctan(np.sinh(mercator_y)))
+
+
+class TileRenderer:
+    """Renders web map tiles from an SRTMManager and keeps them on disk.
+
+    Concurrent requests for the same tile wait for one render. Tiles that
+    are requested hot_threshold times get their neighbours rendered in the
+    background.
+
+    Sample calls:
+    renderer = TileRenderer(SRTMManager(offline=True), 'cache/tiles/gray')
+
+    renderer.get(12, 655, 1583)  # path of the png
+
+    """
+    def __init__(self, srtm_manager, tile_dir, color_map="gray",
+                 min_alt=0, max_alt=3000, min_zoom=7, max_zoom=17,
+                 hot_threshold=2, prefetch_queue_size=256,
+                 max_tracked_requests=65536):
+        import matplotlib.cm as cm
+
+        self.srtm_manager = srtm_manager
+        self.tile_dir = tile_dir
+        self.colormap = cm.get_cmap(color_map)
+        self.min_alt = float(min_alt)
+        self.max_alt = float(max_alt)
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.hot_threshold = hot_threshold
+        self.max_tracked_requests = max_tracked_requests
+
+        # sampling from the SRTMManager is serialized, its tiles are loaded
+        # beforehand holding only the lock of each tile
+        self.srtm_lock = threading.Lock()
+
+        # tiles being rendered, each with an event set when it is done
+        self.pending_lock = threading.Lock()
+        self.pending = {}
+        # (lock, threads using it) for the SRTM tile keys being loaded
+        self.srtm_tile_locks = {}
+
+        # request counts of the most recently requested tiles
+        self.requests = collections.OrderedDict()
+        self.prefetch_queue = Queue.Queue(maxsize=prefetch_queue_size)
+        prefetcher = threading.Thread(target=self._prefetch_worker)
+        prefetcher.daemon = True
+        prefetcher.start()
+
+    def valid_tile(self, z, x, y):
+        return self.min_zoom <= z <= self.max_zoom and \
+            0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+    def tile_path(self, z, x, y):
+        return os.path.join(self.tile_dir, str(z), str(x), "%d.png" % y)
+
+    def get(self, z, x, y):
+        """Return the path of the png for the tile, rendering it first if
+        it is not on disk yet."""
+        filepath = self.tile_path(z, x, y)
+        if os.path.exists(filepath):
+            return filepath
+
+        key = (z, x, y)
+        with self.pending_lock:
+            done = self.pending.get(key)
+            rendering = done is None
+            if rendering:
+                done = self.pending[key] = threading.Event()
+
+        if not rendering:
+            done.wait()
+            if os.path.exists(filepath):
+                return filepath
+            return self.get(z, x, y)  # that render failed, try again
+
+        try:
+            self.render(z, x, y, filepath)
+        finally:
+            with self.pending_lock:
+                del self.pending[key]
+            done.set()
+        return filepath
+
+    def render(self, z, x, y, filepath):
+        import matplotlib.image
+
+        lats = tile_lats(y, z)
+        lngs = tile_lngs(x, z)
+        spacing = min(abs(lngs[1] - lngs[0]), np.abs(np.diff(lats)).min())
+
+        factor = self.srtm_manager.overview_factor(spacing)
+        keys = self.srtm_tile_keys(lats, lngs, factor)
+        # pinned, so other renders can't evict the tiles before sampling
+        self.srtm_manager.pin_tiles(keys)
+        try:
+            # a tile that has to be downloaded or patched only holds up the
+            # requests that need it
+            for key in keys:
+                with self.srtm_tile_lock(key):
+                    self.srtm_manager.prefetch([key], workers=1)
+
+            with self.srtm_lock:
+                alts = self.srtm_manager.get_altitude_grid(lats, lngs,
+                                                           factor)
+        finally:
+            self.srtm_manager.unpin_tiles(keys)
+
+        void = np.isnan(alts)
+        scaled = (alts - self.min_alt) / (self.max_alt - self.min_alt)
+        scaled[void] = 0
+        rgba = self.colormap(np.clip(scaled, 0, 1), bytes=True)
+        rgba[void, 3] = 0  # voids are transparent
+
+        tile_dir = os.path.dirname(filepath)
+        if not os.path.isdir(tile_dir):
+            try:
+                os.makedirs(tile_dir)
+            except OSError:
+                if not os.path.isdir(tile_dir):  # not made by another thread
+                    raise
+        tmp_filepath = '%s.%d.%d.tmp' % (filepath, os.getpid(),
+                                         threading.current_thread().ident)
+        matplotlib.image.imsave(tmp_filepath, rgba, format='png')
+        os.rename(tmp_filepath, filepath)
+
+    @staticmethod
+    def srtm_tile_keys(lats, lngs, factor):
+        """Keys of the SRTM tiles under lats and lngs, the tiles before
+        the overviews built from them."""
+        keys = [SRTMManager.tile_key(lat, lng)
+                for lat in range(int(math.floor(lats.min())),
+                                 int(math.floor(lats.max())) + 1)
+                for lng in range(int(math.floor(lngs.min())),
+                                 int(math.floor(lngs.max())) + 1)]
+        if factor > 1:
+            keys += [key + (factor,) for key in keys]
+        return keys
+
+    @contextlib.contextmanager
+    def srtm_tile_lock(self, key):
+        """Hold the lock of an SRTM tile key, which is dropped once no
+        thread is waiting for it."""
+        with self.pending_lock:
+            lock, users = self.srtm_tile_locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self.srtm_tile_locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self.pending_lock:
+                lock, users = self.srtm_tile_locks[key]
+                if users == 1:
+                    del self.srtm_tile_locks[key]
+                else:
+                    self.srtm_tile_locks[key] = (lock, users - 1)
+
+    def record_request(self, z, x, y):
+        """Count a request for the tile and queue its neighbours for
+        rendering once it turns hot. Only the max_tracked_requests most
+        recently requested tiles are counted."""
+        key = (z, x, y)
+        with self.pending_lock:
+            count = self.requests.pop(key, 0) + 1
+            self.requests[key] = count
+            if len(self.requests) > self.max_tracked_requests:
+                self.requests.popitem(last=False)
+        if count != self.hot_threshold:
+            return
+        for dx, dy in NEIGHBOURS:
+            neighbour = (z, x + dx, y + dy)
+            if not self.valid_tile(*neighbour) or \
+                    os.path.exists(self.tile_path(*neighbour)):
+                continue
+            try:
+                self.prefetch_queue.put_nowait(neighbour)
+            except Queue.Full:
+                return
+
+    def _prefetch_worker(self):
+        while True:
+            z, x, y = self.prefetch_queue.get()
+            try:
+                self.get(z, x, y)
+            except Exception as e:
+                print "prefetching tile %d/%d/%d failed: %s" % (z, x, y, e)
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    path_regex = re.compile(r"^/(\d+)/(\d+)/(\d+)\.png$")
+
+    def do_GET(self):
+        match = self.path_regex.match(self.path.split('?')[0])
+        if not match:
+            self.send_error(404, "Tiles are served as /z/x/y.png")
+            return
+        z, x, y = [int(part) for part in match.groups()]
+        renderer = self.server.renderer
+        if not renderer.valid_tile(z, x, y):
+            self.send_error(404, "No tile %d/%d/%d" % (z, x, y))
+            return
+
+        try:
+            filepath = renderer.get(z, x, y)
+        except Exception as e:
+            self.send_error(500, "Rendering tile failed: %s" % e)
+            return
+        renderer.record_request(z, x, y)
+
+        f = open(filepath, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "max-age=86400")
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, renderer):
+        HTTPServer.__init__(self, address, TileRequestHandler)
+        self.renderer = renderer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve z/x/y map tiles rendered from the SRTM cache.')
+    parser.add_argument('--host', default="127.0.0.1",
+                        help='Address to listen on. Default = 127.0.0.1')
+    parser.add_argument('--port', '-P', default=8000,
+                        help='Port to listen on. Default = 8000')
+    parser.add_argument('--color_map', '-c', default="gray",
+                        help='Colormap to use, defaults to gray')
+    parser.add_argument('--min_alt', default=0,
+                        help='Altitude in meters at the bottom of the '
+                        'colormap. Default = 0')
+    parser.add_argument('--max_alt', default=3000,
+                        help='Altitude in meters at the top of the colormap. '
+                        'Default = 3000')
+    parser.add_argument('--min_zoom', default=7,
+                        help='Lowest zoom level served. Default = 7')
+    parser.add_argument('--max_zoom', default=17,
+                        help='Highest zoom level served. Default = 17')
+    parser.add_argument('--hot_threshold', default=2,
+                        help='Requests after which the tiles around a tile '
+                        'are rendered ahead of time. Default = 2')
+    parser.add_argument('--srtm_format', '-s', default=1,
+                        help='SRTM format. Default is 1')
+    parser.add_argument('--patch_mode', '-u', default="auto",
+                        help='Patch mode for using unpatched files.')
+    parser.add_argument('--tile_cache_dir', default="cache/tiles",
+                        help='Directory for rendered tiles')
+    parser.add_argument('--online', action='store_true', default=False,
+                        help='Download missing SRTM tiles instead of only '
+                        'using cache/srtm*')
+    args = parser.parse_args()
+
+    srtm_format = int(args.srtm_format)
+    srtm_manager = SRTMManager(srtm_format=srtm_format,
+                               patch_mode=args.patch_mode,
+                               offline=not args.online)
+    # rendered tiles depend on everything that changes their pixels
+    tile_dir = os.path.join(args.tile_cache_dir, "%s_%s_%s_srtm%d_%s" % (
+        args.color_map, args.min_alt, args.max_alt, srtm_format,
+        args.patch_mode))
+    renderer = TileRenderer(srtm_manager, tile_dir, color_map=args.color_map,
+                            min_alt=float(args.min_alt),
+                            max_alt=float(args.max_alt),
+                            min_zoom=int(args.min_zoom),
+                            max_zoom=int(args.max_zoom),
+                            hot_threshold=int(args.hot_threshold))
+
+    server = TileServer((args.host, int(args.port)), renderer)
+    print "serving tiles on http://%s:%d/{z}/{x}/{y}.png" % (
+        args.host, int(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
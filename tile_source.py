@@ -0,0 +1,417 @@
+"""Sources SRTMManager downloads SRTM files from.
+
+Every source lists the regions of the SRTM directory and the files in
+each region, and streams a file into the cache. Files are written to a
+temporary file next to the destination and renamed into place, so a
+cache dir never holds a partial tile.
+
+Sample calls:
+source = HTTPTileSource("dds.cr.usgs.gov", "/srtm/version2_1/SRTM1/")
+
+source = MirrorTileSource("/mnt/srtm/SRTM1")
+
+source.fetch("North_America/", "N37W123.hgt.zip",
+             "cache/srtm1/N37W123.hgt.zip")
+
+"""
+import os
+import Queue
+import ftplib
+import socket
+import httplib
+import urlparse
+import threading
+from HTMLParser import HTMLParser
+
+import instrument
+
+
+# bytes streamed at a time
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_SERVER = "dds.cr.usgs.gov"
+
+
+class TileSourceError(Exception):
+    pass
+
+
+def default_directory(srtm_format):
+    """The SRTM directory on the USGS server and its mirrors."""
+    return "/srtm/version2_1/SRTM%s/" % srtm_format
+
+
+class TileSource:
+    """Base class of the sources. Subclasses implement list_regions,
+    list_files and _copy."""
+    def list_regions(self):
+        raise NotImplementedError
+
+    def list_files(self, region):
+        raise NotImplementedError
+
+    def _copy(self, region, filename, fileobj):
+        """Write the file to fileobj and return the number of bytes."""
+        raise NotImplementedError
+
+    def fetch(self, region, filename, filepath):
+        """Download a file to filepath. Returns the number of bytes."""
+        with instrument.span("download", filename=filename) as span:
+            tmp_filepath = '%s.%d.%d.tmp' % (
+                filepath, os.getpid(), threading.current_thread().ident)
+            f = open(tmp_filepath, 'wb')
+            try:
+                nbytes = self._copy(region, filename, f)
+            except:
+                f.close()
+                os.remove(tmp_filepath)
+                raise
+            f.close()
+            os.rename(tmp_filepath, filepath)
+            span.add(bytes=nbytes)
+        return nbytes
+
+    def fetch_many(self, files, cachedir, workers=4):
+        """Download (region, filename) pairs into cachedir with up to
+        workers downloads at a time. Raises the first error once all
+        downloads are done."""
+        files = list(files)
+        pending = Queue.Queue()
+        for region, filename in files:
+            pending.put((region, filename))
+        errors = []
+
+        def download():
+            while True:
+                try:
+                    region, filename = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                print "downloading %s%s" % (region, filename)
+                try:
+                    self.fetch(region, filename,
+                               os.path.join(cachedir, filename))
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=download)
+                   for i in range(max(1, min(workers, len(files))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+
+class HTTPTileSource(TileSource):
+    """Downloads over HTTP(S), keeping up to pool_size connections open
+    between requests so tiles after the first skip the handshakes."""
+    def __init__(self, server=DEFAULT_SERVER, directory=default_directory(1),
+                 secure=True, pool_size=4, timeout=60):
+        self.server = server
+        self.directory = directory
+        self.secure = secure
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pool = Queue.Queue()
+
+    def __getstate__(self):
+        # connections stay with the process that opened them
+        state = self.__dict__.copy()
+        del state['_pool']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pool = Queue.Queue()
+
+    def _connect(self):
+        if self.secure:
+            return httplib.HTTPSConnection(self.server, timeout=self.timeout)
+        return httplib.HTTPConnection(self.server, timeout=self.timeout)
+
+    def _release(self, conn):
+        if self._pool.qsize() < self.pool_size:
+            self._pool.put(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        """Close the pooled connections."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Queue.Empty:
+                return
+
+    def _get(self, path, fileobj=None):
+        """GET path and write the body to fileobj, or return it if fileobj
+        is None. If a pooled connection was closed by the server in the
+        meantime, the request is retried once on a new connection."""
+        for attempt in range(2):
+            conn = None
+            if attempt == 0:
+                try:
+                    conn = self._pool.get_nowait()
+                except Queue.Empty:
+                    pass
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    continue
+                raise
+
+            try:
+                body = self._read(path, response, fileobj)
+            except:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return body
+
+    @staticmethod
+    def _read(path, response, fileobj):
+        if response.status != 200:
+            raise TileSourceError("GET %s: %d %s" % (
+                path, response.status, response.reason))
+        if fileobj is None:
+            return response.read()
+        nbytes = 0
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            fileobj.write(chunk)
+            nbytes += len(chunk)
+        return nbytes
+
+    def _listing(self, path):
+        parser = parseHTMLDirectoryListing()
+        parser.feed(self._get(path))
+        return parser.getDirListing()
+
+    def list_regions(self):
+        return [region for region in self._listing(self.directory)
+                if 'jpg' not in region]
+
+    def list_files(self, region):
+        return self._listing("%s%s" % (self.directory, region))
+
+    def _copy(self, region, filename, fileobj):
+        return self._get("%s%s%s" % (self.directory, region, filename),
+                         fileobj)
+
+
+class FTPTileSource(TileSource):
+    """Downloads over FTP on one connection, opened on first use."""
+    def __init__(self, server=DEFAULT_SERVER, directory=default_directory(1)):
+        self.server = server
+        self.directory = directory
+        self._ftp = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_ftp'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._ftp is None:
+            self._ftp = ftplib.FTP(self.server)
+            self._ftp.login()
+        return self._ftp
+
+    def list_regions(self):
+        with self._lock:
+            ftp = self._connection()
+            ftp.cwd(self.directory)
+            return ftp.nlst()
+
+    def list_files(self, region):
+        with self._lock:
+            ftp = self._connection()
+            ftp.cwd(self.directory + "/" + region)
+            return ftp.nlst()
+
+    def _copy(self, region, filename, fileobj):
+        nbytes = [0]
+
+        def write(data):
+            fileobj.write(data)
+            nbytes[0] += len(data)
+
+        # one transfer at a time on the shared connection
+        with self._lock:
+            ftp = self._connection()
+            ftp.cwd(self.directory + "/" + region)
+            ftp.retrbinary("RETR " + filename, write, CHUNK_SIZE)
+        return nbytes[0]
+
+
+class MirrorTileSource(TileSource):
+    """Copies from a local or network mounted directory laid out like the
+    server's SRTM directory, with one sub directory per region."""
+    def __init__(self, root):
+        self.root = root
+
+    def list_regions(self):
+        return sorted(name + '/' for name in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, name)))
+
+    def list_files(self, region):
+        return sorted(os.listdir(os.path.join(self.root, region)))
+
+    def _copy(self, region, filename, fileobj):
+        source = open(os.path.join(self.root, region, filename), 'rb')
+        nbytes = 0
+        try:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                fileobj.write(chunk)
+                nbytes += len(chunk)
+        finally:
+            source.close()
+        return nbytes
+
+
+class StandInHTTPTileSource(HTTPTileSource):
+    """Serves a mirror directory from a local HTTP server in a background
+    thread and downloads from it like from the real server. Useful to run
+    the whole download path without network access.
+    """
+    def __init__(self, root, directory=default_directory(1), port=0,
+                 pool_size=4):
+        from SimpleHTTPServer import SimpleHTTPRequestHandler
+        from BaseHTTPServer import HTTPServer
+        from SocketServer import ThreadingMixIn
+
+        mirror_root = os.path.abspath(root)
+        prefix = directory.rstrip('/')
+
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep connections alive
+
+            def translate_path(self, path):
+                path = urlparse.urlparse(path).path
+                if not path.startswith(prefix):
+                    return os.path.join(mirror_root, 'missing')
+                relative = path[len(prefix):].lstrip('/')
+                return os.path.join(mirror_root, *relative.split('/'))
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(('127.0.0.1', port), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        HTTPTileSource.__init__(
+            self, server='127.0.0.1:%d' % self.httpd.server_address[1],
+            directory=directory, secure=False, pool_size=pool_size)
+
+    def __getstate__(self):
+        # other processes download from the server of this one
+        state = HTTPTileSource.__getstate__(self)
+        del state['httpd']
+        return state
+
+    def close(self):
+        HTTPTileSource.close(self)
+        if getattr(self, 'httpd', None) is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+
+def from_spec(spec, srtm_format=1):
+    """Return a source for spec: None for the USGS server, an http(s)://
+    or ftp:// URL of a server's SRTM directory, or the path of a mirror
+    directory. A mirror may hold SRTM1/SRTM3 sub directories."""
+    if not spec:
+        return HTTPTileSource(DEFAULT_SERVER, default_directory(srtm_format))
+    url = urlparse.urlparse(spec)
+    if url.scheme in ('http', 'https', 'ftp'):
+        directory = url.path or default_directory(srtm_format)
+        if not directory.endswith('/'):
+            directory += '/'
+        if url.scheme == 'ftp':
+            return FTPTileSource(url.netloc, directory)
+        return HTTPTileSource(url.netloc, directory,
+                              secure=url.scheme == 'https')
+    format_root = os.path.join(spec, 'SRTM%s' % srtm_format)
+    if os.path.isdir(format_root):
+        return MirrorTileSource(format_root)
+    return MirrorTileSource(spec)
+
+
+class parseHTMLDirectoryListing(HTMLParser):
+
+    def __init__(self):
+        #print "parseHTMLDirectoryListing.__init__"
+        HTMLParser.__init__(self)
+        self.title = "Undefined"
+        self.isDirListing = False
+        self.dirList = []
+        self.inTitle = False
+        self.inHyperLink = False
+        self.currAttrs = ""
+        self.currHref = ""
+
+    def handle_starttag(self, tag, attrs):
+        #print "Encountered the beginning of a %s tag" % tag
+        if tag == "title":
+            self.inTitle = True
+        if tag == "a":
+            self.inHyperLink = True
+            self.currAttrs = attrs
+            for attr in attrs:
+                if attr[0] == 'href':
+                    self.currHref = attr[1]
+
+    def handle_endtag(self, tag):
+        #print "Encountered the end of a %s tag" % tag
+        if tag == "title":
+            self.inTitle = False
+        if tag == "a":
+            # This is to avoid us adding the parent directory to the list.
+            if self.currHref != "":
+                self.dirList.append(self.currHref)
+            self.currAttrs = ""
+            self.currHref = ""
+            self.inHyperLink = False
+
+    def handle_data(self, data):
+        if self.inTitle:
+            self.title = data
+            print "title=%s" % data
+            if "Index of" in self.title:
+                #print "it is an index!!!!"
+                self.isDirListing = True
+        if self.inHyperLink:
+            # We do not include parent directory in listing.
+            if "Parent Directory" in data:
+                self.currHref = ""
+
+    def getDirListing(self):
+        return self.dirList
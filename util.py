@@ -1,5 +1,9 @@
 import sys
 
+import numpy as np
+
+import geodesy
+
 
 # Bresenham's circle algorithm:
 # http://www.daniweb.com/software-development/python/threads/321181/python-bresenham-circle-arc-algorithm#
@@ -54,6 +58,44 @@ def filled_circle(radius):
     return coords
 
 
+# filled_circle as a boolean array, the centre pixel is (radius, radius)
+def circle_footprint(radius):
+    footprint = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=bool)
+    for x, y in filled_circle(radius):
+        footprint[radius + y, radius + x] = True
+    return footprint
+
+
+# Rasterizes many lines at once into the same pixels bresenham_line gives
+# for ((start_row, start_col), (end_row, end_col)): the i-th step along the
+# longer axis of a line moves floor((2 * minor * i + major) / (2 * major))
+# steps along the other, where major and minor are the lengths along the
+# two axes. Each line includes both of its end points.
+# Returns arrays of rows, cols and the index of the line of every pixel.
+def line_pixels(start_rows, start_cols, end_rows, end_cols):
+    start_rows = np.asarray(start_rows)
+    start_cols = np.asarray(start_cols)
+    drows = np.asarray(end_rows) - start_rows
+    dcols = np.asarray(end_cols) - start_cols
+
+    major = np.maximum(abs(drows), abs(dcols))
+    minor = np.minimum(abs(drows), abs(dcols))
+    lengths = major + 1
+    lines = np.repeat(np.arange(lengths.size), lengths)
+    steps = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths,
+                                                 lengths)
+    minor_steps = (2 * minor[lines] * steps + major[lines]) // \
+        np.maximum(2 * major[lines], 1)
+
+    # rows are the longer axis when both are as long, as in bresenham_line
+    rows_major = (abs(drows) >= abs(dcols))[lines]
+    rows = start_rows[lines] + np.sign(drows)[lines] * \
+        np.where(rows_major, steps, minor_steps)
+    cols = start_cols[lines] + np.sign(dcols)[lines] * \
+        np.where(rows_major, minor_steps, steps)
+    return rows, cols, lines
+
+
 # Bresenham's line algorithm (calculates the pixels between 2 points):
 # http://en.wikipedia.org/wiki/Bresenham%27s_line_algorithm
 # Code from:
@@ -87,23 +129,14 @@ def bresenham_line((x, y), (x2, y2)):
     return coords
 
 
-# http://stackoverflow.com/a/4913653/1145332
-# haversine formula for calculating distances between 2 coordinates
+# haversine formula for calculating distances between 2 coordinates,
+# see geodesy.haversine
 def haversine(lng1, lat1, lng2, lat2):
-    from math import radians, cos, sin, asin, sqrt
     """
     Calculate the great circle distance between two points
     on the earth (specified in decimal degrees)
     """
-    # convert decimal degrees to radians
-    lng1, lat1, lng2, lat2 = map(radians, [lng1, lat1, lng2, lat2])
-    # haversine formula
-    dlon = lng2 - lng1
-    dlat = lat2 - lat1
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * asin(sqrt(a))
-    km = 6367 * c
-    return km
+    return float(geodesy.haversine(lng1, lat1, lng2, lat2))
 
 
 def update_status(percent):